@@ -0,0 +1,214 @@
+"""Native asyncio (async/await) client for CouchDB, for Python 3.5 or later,
+using Tornado's httpclient on the asyncio event loop (Tornado 5 or later).
+
+This module is not imported by the `couch` package, import it explicitly::
+
+    from couch.aio import AioCouch
+"""
+
+import inspect
+
+from tornado import httpclient
+from tornado.escape import url_escape
+
+from .couch import AsyncCouch, Database, relax_exception
+
+
+__all__ = ["AioCouch"]
+
+
+class AioCouch(AsyncCouch):
+    """Client for asynchronous operations on a CouchDB using native
+    coroutines.
+
+    Example usage::
+
+        import asyncio
+        from couch.aio import AioCouch
+
+        async def run_test():
+            db = AioCouch('mytestdb')
+            await db.create_db()
+            r = await db.save_doc({'msg': 'My first document'})
+            doc = await db.get_doc(r['id'])
+            await db.delete_doc(doc)
+            await db.delete_db()
+            db.close()
+
+        asyncio.run(run_test())
+
+    The client has the API of `AsyncCouch`, and takes the same parameters.
+    The database operations, the basic document operations and view queries
+    are native coroutines, without the overhead of `gen.coroutine`. The
+    other methods are those of AsyncCouch, returning Futures, which may
+    also be awaited. Errors are raised as the same sub-classes of
+    CouchException, e.g. `NotFound` or `Conflict`.
+    """
+
+    def db(self, db_name):
+        """Get a handle for the database `db_name`, see `AsyncCouch.db()`.
+        """
+        return AioDatabase(self, db_name)
+
+    #
+    # Database operations
+    #
+
+    async def create_db(self, db_name=None):
+        """Creates a new database."""
+        return await self._http_put(db_name or self.db_name)
+
+    async def delete_db(self, db_name=None):
+        """Deletes the database."""
+        return await self._http_delete(db_name or self.db_name)
+
+    async def list_dbs(self):
+        """List names of databases."""
+        return await self._http_get('_all_dbs')
+
+    async def info_db(self, db_name=None):
+        """Get info about the database."""
+        return await self._http_get(db_name or self.db_name)
+
+    async def uuids(self, count=1):
+        """Get one or more uuids."""
+        r = await self._http_get('_uuids?count={0}'.format(count))
+        return r['uuids']
+
+    #
+    # Document operations
+    #
+
+    async def get_doc(self, doc_id):
+        """Get document with the given `doc_id`."""
+        if self.cache is not None or self.batch_reads:
+            return await AsyncCouch.get_doc(self, doc_id)
+        url = '{0}/{1}'.format(self.db_name, url_escape(doc_id))
+        return await self._http_get(url)
+
+    async def has_doc(self, doc_id):
+        """Check if document with the given `doc_id` exists.
+        Returns True if document exists, returns False otherwise.
+        """
+        url = '{0}/{1}'.format(self.db_name, url_escape(doc_id))
+        r = await self._http_head(url)
+        return r['code'] == 200
+
+    async def save_doc(self, doc):
+        """Save/create a document to/in a given database. Response is a dict
+        with id and rev of the saved doc.
+        """
+        if self.batch_writes:
+            return await AsyncCouch.save_doc(self, doc)
+        body = self._encode(doc)
+        if '_id' not in doc:
+            # create a new document
+            return await self._http_post(self.db_name, body)
+        # create new document, or update an existing document
+        url = '{0}/{1}'.format(self.db_name, url_escape(doc['_id']))
+        try:
+            return await self._http_put(url, body)
+        finally:
+            self._uncache([doc])
+
+    async def delete_doc(self, doc):
+        """Delete a document.
+        The `doc` shall be a dict, at least having the keys `_id` and `_rev`.
+        """
+        if self.batch_writes:
+            return await AsyncCouch.delete_doc(self, doc)
+        if '_rev' not in doc or '_id' not in doc:
+            raise KeyError('Missing id or revision information in doc')
+        url = '{0}/{1}?rev={2}'.format(
+            self.db_name, url_escape(doc['_id']), doc['_rev'])
+        try:
+            return await self._http_delete(url)
+        finally:
+            self._uncache([doc])
+
+    #
+    # View operations
+    #
+
+    async def view(self, design_doc_name, view_name, **kwargs):
+        """Query a pre-defined view in the specified design doc, see
+        `AsyncCouch.view()` for the query parameters.
+        """
+        url = '{0}/_design/{1}/_view/{2}'.format(
+            self.db_name, design_doc_name, view_name)
+        return await self._query(url, kwargs)
+
+    async def view_all_docs(self, **kwargs):
+        """Query the _all_docs view.
+        Accepts the same keyword parameters as `view()`.
+        """
+        url = '{0}/_all_docs'.format(self.db_name)
+        return await self._query(url, kwargs)
+
+    async def _query(self, url, kwargs):
+        url, body = self._view_request(url, kwargs)
+        if body is not None:
+            return await self._http_post(url, body)
+        return await self._http_get(url)
+
+    #
+    # Basic http methods
+    #
+
+    async def _fetch(self, method, uri, body=None, headers=None,
+                     idempotent=None, admit=True, decode=False, **kwargs):
+        # make a request, returning the response, also on HTTP errors
+        if self.retry is not None or self.limiter is not None or \
+                self.cluster is not None or self.instrument is not None:
+            return await AsyncCouch._fetch(self, method, uri, body, headers,
+                                           idempotent, admit, decode,
+                                           **kwargs)
+        self._test_closed()
+        req = self._request(method, uri, body, headers, kwargs)
+        try:
+            return await self._client.fetch(req)
+        except httpclient.HTTPError as e:
+            if not e.response:
+                raise relax_exception(e)
+            return e.response
+
+    async def _http_get(self, uri, headers=None):
+        if self._decode_get and not (headers and 'Accept' in headers):
+            resp = await self._fetch('GET', uri, headers=headers, decode=True)
+            return self._parse_response(resp)
+        resp = await self._fetch('GET', uri, headers=headers)
+        # not a JSON response, don't try to decode
+        return resp.body
+
+    async def _http_post(self, uri, body, check_errors=True, **kwargs):
+        resp = await self._fetch('POST', uri, body, decode=True, **kwargs)
+        return self._parse_response(resp, check_errors)
+
+    async def _http_put(self, uri, body='', headers=None):
+        if body and 'Content-Type' not in self._headers['PUT'] and \
+                not (headers and 'Content-Type' in headers):
+            headers = dict(headers or {})
+            headers['Content-Type'] = 'application/json'
+        resp = await self._fetch('PUT', uri, body, headers, decode=True)
+        return self._parse_response(resp)
+
+    async def _http_delete(self, uri):
+        resp = await self._fetch('DELETE', uri, decode=True)
+        return self._parse_response(resp)
+
+    async def _http_head(self, uri):
+        resp = await self._fetch('HEAD', uri, decode=True)
+        return self._parse_headers(resp)
+
+
+class AioDatabase(Database):
+    """Handle for a database, made by `AioCouch.db()`."""
+
+    __slots__ = ()
+
+
+# the handle uses the native coroutines of AioCouch, with its own db_name
+for _name, _attr in list(vars(AioCouch).items()):
+    if inspect.isfunction(_attr) and not _name.startswith('__') and \
+            _name != 'db':
+        setattr(AioDatabase, _name, _attr)
@@ -0,0 +1,334 @@
+"""Benchmarks of the client-side overhead of the CouchDB clients.
+
+Run all benchmarks with ``python -m couch.bench``, or only the named
+benchmarks, e.g. ``python -m couch.bench requests``. The server benchmark
+runs workloads against an in-process `couch.fake.FakeCouch`, configured by
+options, e.g. ``python -m couch.bench server --latency 0.001``.
+"""
+
+import argparse
+import copy
+import io
+import timeit
+import time
+
+from tornado import gen, httpclient, ioloop
+from tornado.concurrent import Future
+
+import couch
+
+
+def _report(name, seconds, number, baseline=None):
+    usec = seconds / number * 1e6
+    line = '  {0:<32} {1:10.2f} us/op'.format(name, usec)
+    if baseline is not None:
+        line += '  ({0:.2f}x)'.format(baseline / seconds)
+    print(line)
+
+
+def bench_requests(number=100000):
+    """Building a request from the precomputed request templates, compared
+    to copying and updating the request arguments for each request."""
+    db = couch.AsyncCouch('bench', use_gzip=False, auth_username='user',
+                          auth_password='secret', request_timeout=30.0,
+                          headers={'X-Client': 'bench'})
+
+    def copied():
+        req_args = copy.deepcopy(db.request_args)
+        req_args.setdefault('headers', {}).update({})
+        if 'Accept' not in req_args['headers']:
+            req_args['headers']['Accept'] = 'application/json'
+        return httpclient.HTTPRequest(db.couch_url + 'bench/doc',
+                                      method='GET', **req_args)
+
+    def template():
+        return db._request('GET', 'bench/doc')
+
+    print('Building GET requests:')
+    baseline = timeit.timeit(copied, number=number)
+    _report('deepcopy of request args', baseline, number)
+    _report('request templates', timeit.timeit(template, number=number),
+            number, baseline)
+    db.close()
+
+
+def _make_doc(i):
+    # a typical document, about 0.5 KB JSON encoded
+    return {
+        '_id': 'doc-{0:08d}'.format(i),
+        '_rev': '1-967a00dff5e02add41819138abb3284d',
+        'type': 'order',
+        'customer': {'name': 'Customer {0}'.format(i),
+                     'email': 'customer{0}@example.com'.format(i),
+                     'tags': ['retail', 'priority', 'newsletter']},
+        'lines': [{'sku': 'SKU-{0}'.format(n), 'qty': n, 'price': 9.95 * n}
+                  for n in range(1, 5)],
+        'total': 99.5,
+        'paid': True,
+        'note': 'Deliver to the back door </>',
+    }
+
+
+def bench_codecs(number=20):
+    """Encoding and decoding typical payloads using the JSON codecs."""
+    docs = [_make_doc(i) for i in range(1000)]
+    payloads = [
+        ('doc', docs[0], 1000),
+        ('bulk docs, 1000 docs', {'docs': docs}, 1),
+        ('view, 10000 rows', {'total_rows': 10000, 'offset': 0, 'rows': [
+            {'id': doc['_id'], 'key': doc['_id'], 'value': None, 'doc': doc}
+            for doc in docs * 10]}, 1),
+    ]
+    codecs = [('json_encode/json_decode',
+               (couch.couch.json_encode, couch.couch.json_decode))]
+    for name in ('json', 'orjson', 'ujson'):
+        try:
+            codecs.append((name, couch.json_codec(name)))
+        except ImportError:
+            print('{0} is not installed'.format(name))
+
+    for payload_name, obj, repeat in payloads:
+        body = couch.couch.json_encode(obj).encode('utf8')
+        print('Encoding and decoding {0} ({1:.1f} KB):'.format(
+            payload_name, len(body) / 1024.0))
+        n = number * repeat
+        for prefix, index, arg in (('encode', 0, obj), ('decode', 1, body)):
+            baseline = None
+            for name, codec in codecs:
+                fn = codec[index]
+                seconds = timeit.timeit(lambda: fn(arg), number=n)
+                _report('{0} {1}'.format(prefix, name), seconds, n, baseline)
+                baseline = baseline or seconds
+
+
+class _FakeClient(object):
+    # HTTP client responding to every request with the same body, without
+    # any I/O, to measure only the overhead of the client
+
+    def __init__(self, body):
+        self.body = body
+
+    def fetch(self, request):
+        future = Future()
+        future.set_result(httpclient.HTTPResponse(
+            request, 200, buffer=io.BytesIO(self.body)))
+        return future
+
+    def close(self):
+        pass
+
+
+def _run_native(coro):
+    # run a native coroutine, which completes without suspending, as the
+    # responses of the fake client are done futures
+    try:
+        coro.send(None)
+    except StopIteration as e:
+        return e.value
+    raise RuntimeError('coroutine suspended')
+
+
+def bench_aio(number=20000):
+    """Per-call overhead of get_doc() of the native coroutines of AioCouch,
+    compared to the gen.coroutine methods of AsyncCouch."""
+    try:
+        from couch.aio import AioCouch
+    except (ImportError, SyntaxError):
+        print('couch.aio requires Python 3.5 or later')
+        return
+    body = couch.couch.json_encode(_make_doc(0)).encode('utf8')
+
+    def run():
+        print('Getting docs, without I/O:')
+        db = couch.AsyncCouch('bench')
+        db._client = _FakeClient(body)
+        baseline = timeit.timeit(lambda: db.get_doc('doc').result(),
+                                 number=number)
+        _report('AsyncCouch.get_doc', baseline, number)
+        aio = AioCouch('bench')
+        aio._client = _FakeClient(body)
+        seconds = timeit.timeit(lambda: _run_native(aio.get_doc('doc')),
+                                number=number)
+        _report('AioCouch.get_doc', seconds, number, baseline)
+        db.close()
+        aio.close()
+
+    # futures are made on a running event loop
+    ioloop.IOLoop.current().run_sync(run)
+
+
+def bench_metrics(number=20000):
+    """Per-call overhead of get_doc() of AsyncCouch, without instrument,
+    with the no-op hooks of Instrument and with Metrics."""
+    body = couch.couch.json_encode(_make_doc(0)).encode('utf8')
+
+    def run():
+        print('Getting docs, without I/O:')
+        baseline = None
+        for name, instrument in [('no instrument', None),
+                                 ('Instrument', couch.Instrument()),
+                                 ('Metrics', couch.Metrics())]:
+            db = couch.AsyncCouch('bench', instrument=instrument)
+            db._client = _FakeClient(body)
+            seconds = timeit.timeit(lambda: db.get_doc('doc').result(),
+                                    number=number)
+            _report(name, seconds, number, baseline)
+            baseline = baseline or seconds
+            db.close()
+
+    # futures are made on a running event loop
+    ioloop.IOLoop.current().run_sync(run)
+
+
+def _median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def _workloads(payload):
+    # the workloads as (name, setup, op), where setup is called with a
+    # BlockingCouch on a new database, returning the state, and op is called
+    # with the client, the state and the number of the call
+    data = 'x' * payload
+    attachment = {'mimetype': 'application/octet-stream', 'name': 'data',
+                  'data': b'x' * payload}
+
+    template = _make_doc(0)
+    del template['_rev']
+
+    def doc(doc_id):
+        return dict(template, _id=doc_id, data=data)
+
+    def preload(db, n=1000):
+        ids = ['doc-{0:08d}'.format(i) for i in range(n)]
+        db.save_docs([doc(doc_id) for doc_id in ids])
+        db.save_doc({'_id': '_design/bench', 'views': {'all': {
+            'map': 'function(doc) { emit(doc._id, null); }'}}})
+        return ids
+
+    def with_attachment(db):
+        r = db.save_doc({'_id': 'att'})
+        db.save_attachment({'_id': 'att', '_rev': r['rev']}, attachment)
+        return {'_id': 'att'}
+
+    counter = iter(range(10 ** 9))
+    return [
+        ('get_doc', preload, lambda db, ids, i: db.get_doc(ids[i % len(ids)])),
+        ('save_doc', lambda db: None,
+         lambda db, _, i: db.save_doc(doc('new-{0}'.format(next(counter))))),
+        ('save_docs, 100 docs', lambda db: None,
+         lambda db, _, i: db.save_docs(
+             [doc('new-{0}'.format(next(counter))) for _ in range(100)])),
+        ('view_all_docs, 100 docs', preload,
+         lambda db, _, i: db.view_all_docs(limit=100, include_docs=True)),
+        ('view, 100 rows', preload,
+         lambda db, _, i: db.view('bench', 'all', limit=100)),
+        ('get_attachment', with_attachment,
+         lambda db, doc, i: db.get_attachment(
+             doc, 'data', 'application/octet-stream')),
+        ('save_attachment', lambda db: None,
+         lambda db, _, i: db.save_attachment(
+             {'_id': 'new-{0}'.format(next(counter))}, attachment)),
+    ]
+
+
+def _run_workload(client, op, state, number):
+    # make `number` calls of the op, one at a time, returning the elapsed
+    # time, and the CPU time of the calling thread, in seconds
+    cpu_time = getattr(time, 'thread_time', time.process_time)
+    start, start_cpu = time.time(), cpu_time()
+    if isinstance(client, couch.BlockingCouch):
+        for i in range(number):
+            op(client, state, i)
+    else:
+        @gen.coroutine
+        def run():
+            for i in range(number):
+                yield op(client, state, i)
+        ioloop.IOLoop.current().run_sync(run)
+    return time.time() - start, cpu_time() - start_cpu
+
+
+def bench_server(number=200, repeat=5, latency=0.0, payload=512):
+    """Throughput, CPU time and memory of AsyncCouch and BlockingCouch, on
+    single doc, bulk, view and attachment workloads, with a FakeCouch
+    server in a background thread.
+
+    Each workload is run `repeat` times on a new database, making `number`
+    calls one at a time, after a warm-up. The median ops/s and CPU time
+    per call of the client thread are reported, and the peak memory
+    allocated during a run, including the allocations of the server. The
+    server delays each request by `latency` seconds, and the docs and
+    attachments have a payload of `payload` bytes.
+    """
+    import tracemalloc
+    from couch.fake import FakeCouch
+
+    print('Workloads with FakeCouch, latency {0} ms, payload {1} bytes, '
+          '{2} calls:'.format(latency * 1000, payload, number))
+    print('  {0:<40} {1:>10} {2:>14} {3:>12}'.format(
+        'workload', 'ops/s', 'CPU us/op', 'peak KB'))
+    with FakeCouch(latency) as server:
+        admin = couch.BlockingCouch(couch_url=server.url, use_gzip=False)
+        for name, setup, op in _workloads(payload):
+            for kind in (couch.AsyncCouch, couch.BlockingCouch):
+                db = kind('bench', server.url, use_gzip=False)
+                rates, cpus = [], []
+                for i in range(repeat + 2):
+                    admin.use('bench', server.url)
+                    admin.create_db()
+                    state = setup(admin)
+                    if i == 0:
+                        # warm-up
+                        _run_workload(db, op, state, number // 10 or 1)
+                    elif i <= repeat:
+                        seconds, cpu = _run_workload(db, op, state, number)
+                        rates.append(number / seconds)
+                        cpus.append(cpu / number)
+                    else:
+                        tracemalloc.start()
+                        _run_workload(db, op, state, number)
+                        peak = tracemalloc.get_traced_memory()[1]
+                        tracemalloc.stop()
+                    admin.delete_db()
+                print('  {0:<40} {1:10.0f} {2:14.1f} {3:12.1f}'.format(
+                    '{0} {1}'.format(kind.__name__, name), _median(rates),
+                    _median(cpus) * 1e6, peak / 1024.0))
+                db.close()
+        admin.close()
+
+
+BENCHMARKS = [
+    ('requests', bench_requests),
+    ('codecs', bench_codecs),
+    ('aio', bench_aio),
+    ('metrics', bench_metrics),
+    ('server', bench_server),
+]
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m couch.bench', description=__doc__.split('\n')[0])
+    parser.add_argument('names', nargs='*', metavar='name',
+                        help='benchmarks to run: ' + ', '.join(
+                            name for name, _ in BENCHMARKS))
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='server latency in seconds (server)')
+    parser.add_argument('--payload', type=int, default=512,
+                        help='doc and attachment payload in bytes (server)')
+    parser.add_argument('--number', type=int, default=200,
+                        help='calls per run (server)')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='runs per workload (server)')
+    args = parser.parse_args(args)
+    for name, bench in BENCHMARKS:
+        if not args.names or name in args.names:
+            if bench is bench_server:
+                bench(args.number, args.repeat, args.latency, args.payload)
+            else:
+                bench()
+
+
+if __name__ == '__main__':
+    main()
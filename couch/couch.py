@@ -5,28 +5,179 @@ This module wraps the CouchDB HTTP REST API and defines a common interface
 for making blocking and non-blocking operations on a CouchDB.
 """
 
+import bisect
+import collections
 import copy
 import functools
+import gzip
+import inspect
 import json
+import numbers
+import os
+import random
+import re
+import threading
+import time
+import uuid
 
 import tornado.ioloop
-from tornado import httpclient, gen
+from tornado import httpclient, httputil, gen, locks, queues
+from tornado.concurrent import Future
 
-from tornado.escape import json_decode, url_escape
+from tornado.escape import json_decode, url_escape, utf8
 
 
-__all__ = ["BlockingCouch", "AsyncCouch", "CouchException", "NotModified",
-           "BadRequest", "NotFound", "MethodNotAllowed", "Conflict",
-           "PreconditionFailed", "InternalServerError"]
+__all__ = ["BlockingCouch", "AsyncCouch", "ThreadedCouch", "Cluster",
+           "ConnectionPool", "DocCache", "Limiter", "RetryPolicy",
+           "Instrument", "Metrics", "RequestInfo", "json_codec",
+           "CouchException", "NotModified", "BadRequest", "NotFound",
+           "MethodNotAllowed", "Conflict", "PreconditionFailed",
+           "InternalServerError", "CircuitOpen"]
 
 __version__ = '0.3.0'
 
 
+try:
+    from concurrent import futures
+except ImportError:
+    # Python 2 without the futures package, there is no ThreadedCouch
+    futures = None
+
+try:
+    _StopAsyncIteration = StopAsyncIteration
+except NameError:
+    # Python < 3.5, there is no `async for`
+    _StopAsyncIteration = StopIteration
+
+try:
+    json.loads(b'{}')
+    _json_loads = json.loads
+except TypeError:
+    # Python 3 < 3.6, json.loads does not accept bytes
+    _json_loads = json_decode
+
+
 def json_encode(value):
     """JSON-encodes the given Python object."""
     return json.dumps(value, allow_nan=False).replace("</", "<\\/")
 
 
+def json_codec(name):
+    """Get a tuple of functions for encoding and decoding JSON, using the
+    named JSON library: 'json', 'orjson' or 'ujson'. A tuple of functions
+    may be given instead of the name, and is returned as is.
+
+    Unlike `json_encode()`, the encode functions do not escape "</", as it
+    is not needed for CouchDB.
+    """
+    if isinstance(name, tuple):
+        return name
+    elif name == 'json':
+        return (functools.partial(json.dumps, allow_nan=False,
+                                  separators=(',', ':')),
+                _json_loads)
+    elif name == 'orjson':
+        import orjson
+        return orjson.dumps, orjson.loads
+    elif name == 'ujson':
+        import ujson
+        return (functools.partial(ujson.dumps, ensure_ascii=False,
+                                  escape_forward_slashes=False),
+                ujson.loads)
+    raise ValueError('Unknown JSON codec: {0}'.format(name))
+
+
+def _error_code(error):
+    """Get the HTTP status code for an error in a list of rows."""
+    return {'unauthorized': 401, 'forbidden': 403, 'not_found': 404,
+            'conflict': 409}.get(error, 400)
+
+
+# POST requests only reading from the database, that may be retried
+_read_post = re.compile(r'/(_all_docs|_design_docs|_view/[^/?]+|_find|'
+                        r'_explain|_bulk_get)(\?|$)')
+
+
+def _http_client(impl, io_loop=None, **kwargs):
+    # make an instance of the HTTP client implementation `impl`, for use on
+    # `io_loop`, or the current IOLoop. From Tornado 5 on, a client is bound
+    # to the IOLoop current when it is made
+    if io_loop is None:
+        return impl(force_instance=True, **kwargs)
+    if tornado.version_info < (5,):
+        return impl(io_loop=io_loop, force_instance=True, **kwargs)
+    if io_loop is tornado.ioloop.IOLoop.current(instance=False):
+        return impl(force_instance=True, **kwargs)
+    client = []
+    io_loop.run_sync(lambda: client.append(
+        impl(force_instance=True, **kwargs)))
+    return client[0]
+
+
+def _query_string(params):
+    """Encode query parameters where only booleans, lists and dicts are
+    JSON-encoded, e.g. for the `_changes` feed, which takes plain string
+    values."""
+    def encode(value):
+        if isinstance(value, (bool, list, dict)):
+            return json_encode(value)
+        elif isinstance(value, numbers.Number):
+            return str(value)
+        return value
+    return '&'.join('{0}={1}'.format(key, url_escape(encode(value)))
+                    for key, value in sorted(params.items())
+                    if value is not None)
+
+
+def _open_file(file, mode, compress=None):
+    """Open the `file`, a path or a file object, optionally gzip compressed,
+    returns the file object and a function for closing it."""
+    if not hasattr(file, 'read' if 'r' in mode else 'write'):
+        if compress is None:
+            compress = file.endswith('.gz')
+        f = (gzip.open if compress else open)(file, mode)
+        return f, f.close
+    if compress:
+        f = gzip.GzipFile(fileobj=file, mode=mode)
+        return f, f.close
+    # files given as objects are not closed
+    return file, lambda: None
+
+
+def _file_producer(file, chunk_size):
+    """Make a body producer reading the `file`, a path or a file object, in
+    chunks, returns the producer and the size of the file, if known."""
+    if not hasattr(file, 'read'):
+        path, start = file, None
+        size = os.path.getsize(path)
+    else:
+        path = None
+        try:
+            start = file.tell()
+            file.seek(0, os.SEEK_END)
+            size = file.tell() - start
+            file.seek(start)
+        except Exception:
+            # not a seekable file, it can only be read once
+            start = size = None
+
+    @gen.coroutine
+    def produce(write):
+        f = open(path, 'rb') if path is not None else file
+        try:
+            if start is not None:
+                f.seek(start)
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                yield write(chunk)
+        finally:
+            if path is not None:
+                f.close()
+    return produce, size
+
+
 class AsyncCouch(object):
     """Basic wrapper class for asynchronous operations on a CouchDB
 
@@ -53,7 +204,10 @@ class AsyncCouch(object):
     """
 
     def __init__(self, db_name='', couch_url='http://127.0.0.1:5984/',
-                 io_loop=None, **request_args):
+                 io_loop=None, batch_writes=False, batch_delay=0.005,
+                 batch_size=500, batch_reads=False, cache=None, codec='json',
+                 pool=None, retry=None, limiter=None, priority=None,
+                 instrument=None, **request_args):
         """Creates an `AsyncCouch`.
 
         All parameters are optional. Though `db_name` is required for most
@@ -61,9 +215,48 @@ class AsyncCouch(object):
 
         Database name `db_name` may be set on init and changed later by
         `use()`. The url to the CouchDB including port number, with or
-        without authentication credentials.
-
-        The `io_loop` is passed to the AsyncHTTPClient, used for connecting.
+        without authentication credentials. For a CouchDB cluster,
+        `couch_url` may be a list of the urls of the nodes, or a `Cluster`.
+
+        Unless a `pool` is given, the client has an AsyncHTTPClient of its
+        own, used on the `io_loop`, or the current IOLoop, and closed by
+        `close()`.
+        Instead, a `ConnectionPool` may be given as `pool`, for configuring
+        the HTTP client, and sharing it between several clients.
+
+        If `batch_writes` is True, calls to `save_doc()` and `delete_doc()`
+        made within `batch_delay` seconds of each other are saved together
+        using the bulk docs API, in batches of at most `batch_size` docs.
+        Each call still gets its own result, or exception, e.g. `Conflict`.
+
+        If `batch_reads` is True, calls to `get_doc()` made in the same
+        IOLoop iteration are fetched together in one request. Concurrent
+        calls for the same document share the request, and each get a copy
+        of the document.
+
+        A `DocCache` given as `cache` is used by `get_doc()` and
+        `get_docs()`. Cached documents are revalidated with the database
+        using their ETag or revision, and are invalidated when saved or
+        deleted using this client.
+
+        A `RetryPolicy` given as `retry` is used for retrying failed
+        requests, and for failing fast while the database is failing.
+
+        A `Limiter` given as `limiter` limits the requests in flight, and
+        the rate of writes. Requests are admitted by the `priority` of the
+        client, 'interactive' or 'batch', or if None, reads are interactive
+        and writes are batch requests. Continuous changes feeds are not
+        limited.
+
+        An `Instrument` given as `instrument`, e.g. `Metrics`, is called
+        before and after each request, with a `RequestInfo` about the
+        request and its timing.
+
+        The `codec` used for encoding and decoding JSON is 'json' (the
+        standard library), 'orjson', 'ujson', or a tuple of encode and decode
+        functions. The decode function is passed bytes, and the encode
+        function may return str or bytes. Note that only the 'json' codec
+        raises ValueError on encoding NaN or infinite floats.
 
         Keyword arguments in `request_args` are applied when making requests
         to the database. By default the request argument `use_gzip` is True.
@@ -72,30 +265,71 @@ class AsyncCouch(object):
 
         The request arguments may include `auth_username` and `auth_password`
         for basic authentication. See `httpclient.HTTPRequest` for other
-        possible arguments.
+        possible arguments. The request arguments are prepared for each
+        request method on init, later changes to `request_args` have no
+        effect.
         """
         self.request_args = request_args
+        self.pool = pool
+        self._make_templates()
         self._closed = False
         self.io_loop = io_loop
-        self._client = httpclient.AsyncHTTPClient(self.io_loop)
+        self.batch_writes = batch_writes
+        self.batch_delay = batch_delay
+        self.batch_size = batch_size
+        self._write_batches = {}
+        self.batch_reads = batch_reads
+        self._read_batches = {}
+        self._read_futures = {}
+        self.cache = cache
+        self.retry = retry
+        self.limiter = limiter
+        self.priority = priority
+        self.instrument = instrument
+        self._encode, self._decode = json_codec(codec)
+        if pool is None:
+            self._client = _http_client(httpclient.AsyncHTTPClient,
+                                        self.io_loop)
+        else:
+            self._client = pool.client
         self.use(db_name, couch_url)
 
     def use(self, db_name='', couch_url='http://127.0.0.1:5984/'):
         """Set database name `db_name` and `couch_url`.
 
         The `couch_url` should include port number and authentication
-        credentials as necessary.
+        credentials as necessary. It may be a list of node urls, or a
+        `Cluster`, for making requests to the nodes of a CouchDB cluster.
         """
         self.db_name = db_name
+        if isinstance(couch_url, (list, tuple)):
+            couch_url = Cluster(couch_url)
+        if isinstance(couch_url, Cluster):
+            self.cluster = couch_url
+            couch_url = couch_url.nodes[0].url
+        else:
+            self.cluster = None
         if couch_url.endswith('/'):
             self.couch_url = couch_url
         else:
             self.couch_url = couch_url + '/'
 
+    def db(self, db_name):
+        """Get a handle for the database `db_name`.
+
+        The handle has the database, document, view and attachment methods
+        of this client, operating on the named database, and shares the
+        HTTP client, configuration and caches of this client. Getting a
+        handle makes no requests, and the handle needs not be closed.
+        """
+        return Database(self, db_name)
+
     def close(self):
         """Closes the CouchDB client, freeing any resources used."""
         if not self._closed:
-            self._client.close()
+            if self.pool is None:
+                # a shared client is closed by its pool
+                self._client.close()
             self._closed = True
 
     #
@@ -131,7 +365,7 @@ class AsyncCouch(object):
         """Replicate changes from a source database to current (target)
         database.
         """
-        body = json_encode({
+        body = self._encode({
             'source': source,
             'target': (db_name or self.db_name),
             'create_target': create_target
@@ -145,6 +379,38 @@ class AsyncCouch(object):
         r = yield self._http_get('_uuids?count={0}'.format(count))
         raise gen.Return(r['uuids'])
 
+    def changes(self, feed='continuous', since=None, heartbeat=30000,
+                request_timeout=None, queue_size=1000, **kwargs):
+        """Follow the changes feed of the database.
+
+        Returns a `ChangesFeed`, delivering the change rows as they are
+        received from the database. The feed type `feed` is one of
+        'continuous', 'longpoll', 'eventsource' or 'normal'. Except for a
+        'normal' feed, the feed is re-requested from the last seen sequence
+        when the database ends a response, until the `ChangesFeed` is closed.
+
+        Start from the sequence `since`, e.g. a previously seen `last_seq`,
+        or 'now'. The database sends a heartbeat every `heartbeat`
+        milliseconds, and unless `request_timeout` is given, the requests will
+        not time out while there is a heartbeat.
+
+        At most `queue_size` change rows received are queued until consumed.
+        When the queue is full, the request is aborted, and the feed is
+        re-requested from the last queued change when the consumer has
+        caught up, such that the memory used is bounded. A longpoll feed
+        also polls again when the consumer has caught up.
+
+        Other keyword arguments are passed as query parameters, e.g.
+        `include_docs=True`, `filter='design/name'` or `style='all_docs'`.
+        """
+        if feed not in ('continuous', 'longpoll', 'eventsource', 'normal'):
+            raise ValueError('Unknown changes feed type: {0}'.format(feed))
+        if request_timeout is None and heartbeat:
+            request_timeout = 0
+        stream = ChangesFeed(since, queue_size)
+        self._run_changes(stream, feed, heartbeat, request_timeout, kwargs)
+        return stream
+
     #
     # Document operations
     #
@@ -152,6 +418,12 @@ class AsyncCouch(object):
     @gen.coroutine
     def get_doc(self, doc_id):
         """Get document with the given `doc_id`."""
+        if self.cache is not None:
+            r = yield self._get_doc_cached(doc_id)
+            raise gen.Return(r)
+        if self.batch_reads and not doc_id.startswith('_local/'):
+            r = yield self._batch_read(doc_id)
+            raise gen.Return(r)
         url = '{0}/{1}'.format(self.db_name, url_escape(doc_id))
         r = yield self._http_get(url)
         raise gen.Return(r)
@@ -166,30 +438,51 @@ class AsyncCouch(object):
         raise gen.Return(r['code'] == 200)
 
     @gen.coroutine
-    def get_docs(self, doc_ids):
+    def get_docs(self, doc_ids, missing='raise', chunk_size=1000,
+                 concurrency=4):
         """Get multiple documents with the given list of `doc_ids`.
 
         Response is a list with the requested documents, in same order as the
         provided document id's.
 
         If one or more documents are not found in the database, a NotFound
-        exception is raised.
+        exception is raised, and deleted documents are None, unless
+        `missing` is given as the value to use for both, e.g. None.
+
+        Long lists of ids are split in chunks of `chunk_size` ids, fetched
+        with at most `concurrency` requests in flight.
         """
-        url = '{0}/_all_docs?include_docs=true'.format(self.db_name)
-        body = json_encode({'keys': doc_ids})
-        r = yield self._http_post(url, body)
-        raise gen.Return([row['doc'] for row in r['rows']])
+        chunks = [doc_ids[i:i + chunk_size]
+                  for i in range(0, len(doc_ids), chunk_size)]
+        results = [None] * len(chunks)
+        pending = iter(enumerate(chunks))
+
+        @gen.coroutine
+        def get_chunks():
+            for i, chunk in pending:
+                results[i] = yield self._get_docs_chunk(chunk, missing)
+
+        yield [get_chunks() for _ in range(min(concurrency, len(chunks)))]
+        raise gen.Return([doc for docs in results for doc in docs])
 
     @gen.coroutine
     def save_doc(self, doc):
         """Save/create a document to/in a given database. Response is a dict
         with id and rev of the saved doc.
         """
-        body = json_encode(doc)
-        if '_id' in doc:
+        body = self._encode(doc)
+        if self.batch_writes:
+            try:
+                r = yield self._batch_write(body)
+            finally:
+                self._uncache([doc])
+        elif '_id' in doc:
             # create new document, or update an existing document
             url = '{0}/{1}'.format(self.db_name, url_escape(doc['_id']))
-            r = yield self._http_put(url, body)
+            try:
+                r = yield self._http_put(url, body)
+            finally:
+                self._uncache([doc])
         else:
             # create a new document
             url = self.db_name
@@ -203,8 +496,13 @@ class AsyncCouch(object):
         """
         # use bulk docs API to update the docs
         url = '{0}/_bulk_docs'.format(self.db_name)
-        body = json_encode({'all_or_nothing': all_or_nothing, 'docs': docs})
-        r = yield self._http_post(url, body)
+        body = self._encode({'all_or_nothing': all_or_nothing, 'docs': docs})
+        # saving docs with ids is idempotent, and may be retried
+        idempotent = all('_id' in doc for doc in docs)
+        try:
+            r = yield self._http_post(url, body, idempotent=idempotent)
+        finally:
+            self._uncache(docs)
         raise gen.Return(r)
 
     @gen.coroutine
@@ -214,9 +512,17 @@ class AsyncCouch(object):
         """
         if '_rev' not in doc or '_id' not in doc:
             raise KeyError('Missing id or revision information in doc')
-        url = '{0}/{1}?rev={2}'.format(
-            self.db_name, url_escape(doc['_id']), doc['_rev'])
-        r = yield self._http_delete(url)
+        try:
+            if self.batch_writes:
+                r = yield self._batch_write(self._encode(
+                    {'_id': doc['_id'], '_rev': doc['_rev'],
+                     '_deleted': True}))
+            else:
+                url = '{0}/{1}?rev={2}'.format(
+                    self.db_name, url_escape(doc['_id']), doc['_rev'])
+                r = yield self._http_delete(url)
+        finally:
+            self._uncache([doc])
         raise gen.Return(r)
 
     @gen.coroutine
@@ -233,11 +539,122 @@ class AsyncCouch(object):
                     '_deleted': True} for doc in docs]
         # use bulk docs API to update the docs
         url = '{0}/_bulk_docs'.format(self.db_name)
-        body = json_encode({'all_or_nothing': all_or_nothing,
-                            'docs': deleted})
-        r = yield self._http_post(url, body)
+        body = self._encode({'all_or_nothing': all_or_nothing,
+                             'docs': deleted})
+        try:
+            r = yield self._http_post(url, body, idempotent=True)
+        finally:
+            self._uncache(docs)
         raise gen.Return(r)
 
+    def bulk_load(self, docs, chunk_size=1000, chunk_bytes=4194304,
+                  concurrency=4, on_saved=None, on_error=None,
+                  on_progress=None):
+        """Save the documents of the iterable `docs`, e.g. a generator, using
+        the bulk docs API, in chunks of at most `chunk_size` docs and, unless
+        a single doc is larger, `chunk_bytes` bytes, keeping `concurrency`
+        requests in flight. The docs are taken from the iterable and encoded
+        as the requests are made, so any number of docs may be loaded.
+
+        For each saved doc, `on_saved` is called with the result having
+        `id` and `rev`, and for each doc failing to save, `on_error` is
+        called with the result having `id`, `error` and `reason`. After each
+        chunk, `on_progress` is called with the stats of the load.
+
+        Response is the stats of the load, a dict with the number of `docs`
+        saved, `errors`, `bytes` sent, `seconds` elapsed, and the throughput
+        in `docs_per_sec` and `mb_per_sec`. If a request or a callback
+        fails, no more requests are made, and the exception is raised after
+        the requests in flight are done.
+        """
+        items = ((doc.get('_id'), utf8(self._encode(doc))) for doc in docs)
+        return self._bulk_load(items, True, chunk_size, chunk_bytes,
+                               concurrency, on_saved, on_error, on_progress)
+
+    @gen.coroutine
+    def export_docs(self, output, partitions=4, split='sample',
+                    page_size=1000, compress=None, attachments=True):
+        """Export all documents of the database as newline-delimited JSON,
+        one doc per line, to `output`, a file path or a binary file object.
+
+        The ids are split into `partitions` ranges, by sampling the ids of
+        the database, if `split` is 'sample', or else by splitting `split`,
+        an alphabet of the first character of the ids, e.g. the hexadecimal
+        digits of generated ids. The ranges are exported concurrently, in
+        pages of `page_size` docs. The output is gzip compressed if
+        `compress` is True, or if None, if the path ends with '.gz'. The
+        attachments are included in the docs, unless `attachments` is False.
+
+        Response is a dict with the number of `docs` exported, `bytes`
+        written (before compression) and `seconds` elapsed.
+        """
+        start = time.time()
+        if split == 'sample':
+            bounds = yield self._sample_ids(partitions)
+        else:
+            alphabet = sorted(set(split))
+            bounds = sorted(set(alphabet[len(alphabet) * i // partitions]
+                                for i in range(1, partitions)))
+        ranges = list(zip([None] + bounds, bounds + [None]))
+        stats = {'docs': 0, 'bytes': 0, 'seconds': 0.0}
+        f, close = _open_file(output, 'wb', compress)
+
+        @gen.coroutine
+        def export_range(startkey, endkey):
+            params = {'include_docs': True}
+            if attachments:
+                params['attachments'] = True
+            if startkey is not None:
+                params['startkey'] = startkey
+            if endkey is not None:
+                params.update(endkey=endkey, inclusive_end=False)
+            rows = self.view_all_docs_paged(page_size, **params)
+            while (yield rows.fetch_next):
+                line = utf8(self._encode(rows.next_object()['doc'])) + b'\n'
+                f.write(line)
+                stats['docs'] += 1
+                stats['bytes'] += len(line)
+
+        try:
+            yield [export_range(*r) for r in ranges]
+        finally:
+            close()
+        stats['seconds'] = time.time() - start
+        raise gen.Return(stats)
+
+    def import_docs(self, input, new_edits=False, compress=None,
+                    **kwargs):
+        """Import documents from newline-delimited JSON, as written by
+        `export_docs()`, from `input`, a file path or a binary file object.
+
+        The docs are saved using `bulk_load()`, taking its keyword arguments
+        `kwargs`, without decoding and encoding each doc. By default the
+        docs are saved with their revisions, as when replicating, which
+        requires `new_edits` False. The results are then only given for docs
+        failing to save. The input is gzip decompressed if `compress` is
+        True, or if None, if the path ends with '.gz'. Response is the stats
+        of the load.
+        """
+        # the doc ids are only needed, if saving new revisions, or for
+        # invalidating cached docs
+        get_id = (new_edits or self.cache is not None) and \
+            (lambda line: self._decode(line).get('_id'))
+
+        def read_docs():
+            f, close = _open_file(input, 'rb', compress)
+            try:
+                for line in f:
+                    line = line.strip()
+                    if line:
+                        yield (get_id(line) if get_id else None), line
+            finally:
+                close()
+
+        args = dict(chunk_size=1000, chunk_bytes=4194304, concurrency=4,
+                    on_saved=None, on_error=None, on_progress=None)
+        args.update(kwargs)
+        return self._bulk_load(read_docs(), new_edits, **args)
+
     @gen.coroutine
     def get_attachment(self, doc, attachment_name, mimetype=None):
         """Get document attachment.
@@ -277,9 +694,173 @@ class AsyncCouch(object):
             '?rev={0}'.format(doc['_rev']) if '_rev' in doc else '')
         headers = {'Content-Type': attachment['mimetype']}
         body = attachment['data']
-        r = yield self._http_put(url, body, headers=headers)
+        try:
+            r = yield self._http_put(url, body, headers=headers)
+        finally:
+            self._uncache([doc])
         raise gen.Return(r)
 
+    @gen.coroutine
+    def upload_attachment(self, doc, attachment_name, source,
+                          mimetype='application/octet-stream', length=None,
+                          chunk_size=65536):
+        """Save an attachment to the specified doc, streaming the data from
+        `source`, a file path, a binary file object, or a body producer, a
+        function called with a `write` function, returning a Future, as
+        `body_producer` of `httpclient.HTTPRequest`.
+        The doc shall be a dict, at least having the key `_id`, and if doc is
+        existing in the database, it shall also contain the key `_rev`.
+
+        Files are read in chunks of `chunk_size` bytes, and the `length` of
+        the data is found from the file, unless given. Data of unknown
+        length is sent using chunked transfer encoding. Streaming uploads
+        are not supported by the curl HTTP client."""
+        url = '{0}/{1}/{2}{3}'.format(
+            self.db_name, url_escape(doc['_id']),
+            url_escape(attachment_name),
+            '?rev={0}'.format(doc['_rev']) if '_rev' in doc else '')
+        if callable(source):
+            producer, idempotent = source, False
+        else:
+            producer, size = _file_producer(source, chunk_size)
+            # files, that can not be read again, are not retried
+            idempotent = size is not None
+            if length is None:
+                length = size
+        headers = {'Content-Type': mimetype}
+        if length is not None:
+            headers['Content-Length'] = str(length)
+        try:
+            resp = yield self._fetch('PUT', url, headers=headers, decode=True,
+                                     body_producer=producer,
+                                     idempotent=idempotent)
+        finally:
+            self._uncache([doc])
+        raise gen.Return(self._parse_response(resp))
+
+    @gen.coroutine
+    def download_attachment(self, doc, attachment_name, dest, range=None):
+        """Get document attachment, streaming the data to `dest`, a file
+        path, a binary file object, or a function called with each chunk of
+        data as it is received.
+        The parameter `doc` should at least contain an `_id` key.
+
+        A part of the attachment is requested, if `range` is given as a
+        tuple of the first and last byte positions, where the last may be
+        None. Response is a dict of the response headers, and the status
+        `code`, e.g. 206 for a partial response."""
+        url = '{0}/{1}/{2}'.format(self.db_name, url_escape(doc['_id']),
+                                   url_escape(attachment_name))
+        headers = {'Accept': '*/*'}
+        if range is not None:
+            headers['Range'] = 'bytes={0}-{1}'.format(
+                range[0], '' if range[1] is None else range[1])
+        if callable(dest):
+            write, close = dest, lambda: None
+        else:
+            f, close = _open_file(dest, 'wb', False)
+            write = f.write
+        try:
+            resp = yield self._http_stream(url, write, headers=headers)
+        finally:
+            close()
+        raise gen.Return(self._parse_headers(resp))
+
+    @gen.coroutine
+    def save_doc_multipart(self, doc, attachments):
+        """Save a document and its attachments in one multipart/related
+        request. Response is a dict with id and rev of the saved doc.
+        The doc shall be a dict, at least having the key `_id`, and if doc is
+        existing in the database, it shall also contain the key `_rev`.
+
+        The `attachments` shall be a list of dicts with keys `name`,
+        `mimetype`, and `data` or `source`. The `data` is the content as
+        bytes. The `source`, a file path, a binary file object, or a body
+        producer, is streamed like by `upload_attachment()`, and its
+        `length` shall be given, unless it can be found from the file.
+        Attachments of the doc, not in `attachments`, are kept."""
+        boundary = uuid.uuid4().hex.encode('ascii')
+        stubs = collections.OrderedDict(doc.get('_attachments') or {})
+        parts = []
+        idempotent = True
+        for attachment in attachments:
+            if 'data' in attachment:
+                data = utf8(attachment['data'])
+                producer, length = None, len(data)
+            else:
+                source = attachment['source']
+                if callable(source):
+                    producer, length = source, None
+                else:
+                    producer, length = _file_producer(source, 65536)
+                # files, that can not be read again, are not retried
+                idempotent = idempotent and length is not None
+                length = attachment.get('length', length)
+                if length is None:
+                    raise ValueError('Unknown length of attachment {0}'.format(
+                        attachment['name']))
+                data = None
+            # the attachments follow the doc, in the order given in the doc
+            stubs.pop(attachment['name'], None)
+            stubs[attachment['name']] = {
+                'follows': True, 'content_type': attachment['mimetype'],
+                'length': length}
+            parts.append((data, producer, length))
+        body = dict(doc)
+        body['_attachments'] = stubs
+        head = b''.join([b'--', boundary,
+                         b'\r\nContent-Type: application/json\r\n\r\n',
+                         utf8(self._encode(body))])
+        separator = b'\r\n--' + boundary + b'\r\n\r\n'
+        tail = b'\r\n--' + boundary + b'--'
+
+        @gen.coroutine
+        def produce(write):
+            yield write(head)
+            for data, producer, _ in parts:
+                yield write(separator)
+                if producer is None:
+                    yield write(data)
+                else:
+                    yield producer(write)
+            yield write(tail)
+
+        length = len(head) + len(tail) + sum(
+            len(separator) + length for _, _, length in parts)
+        headers = {'Content-Type': 'multipart/related; boundary="{0}"'.format(
+                       boundary.decode('ascii')),
+                   'Content-Length': str(length)}
+        url = '{0}/{1}'.format(self.db_name, url_escape(doc['_id']))
+        try:
+            resp = yield self._fetch('PUT', url, headers=headers, decode=True,
+                                     body_producer=produce,
+                                     idempotent=idempotent)
+        finally:
+            self._uncache([doc])
+        raise gen.Return(self._parse_response(resp))
+
+    @gen.coroutine
+    def get_doc_multipart(self, doc_id, dest=None, **kwargs):
+        """Get document with the given `doc_id` and its attachments, in one
+        multipart/related response, without base64 encoding the attachments.
+
+        If `dest` is given, it is called with the name and info of each
+        attachment, from the `_attachments` of the doc, and shall return a
+        function, called with each chunk of data of the attachment as it is
+        received, e.g. the `write` method of a file. Else, the data of each
+        attachment is set as bytes in the `data` of its info.
+
+        Keyword arguments in `kwargs` are passed as query parameters, e.g.
+        `rev`, or `atts_since` for only getting attachments changed since
+        the given revisions."""
+        url = '{0}/{1}?{2}'.format(self.db_name, url_escape(doc_id),
+                                   _query_string(dict(kwargs,
+                                                      attachments=True)))
+        parser = _MultipartParser(dest, self._decode)
+        headers = {'Accept': 'multipart/related, application/json'}
+        yield self._http_stream(url, parser.feed, headers=headers)
+        raise gen.Return(parser.close())
+
     @gen.coroutine
     def delete_attachment(self, doc, attachment_name):
         """Delete a named attachment to the specified doc.
@@ -290,7 +871,10 @@ class AsyncCouch(object):
             url = '{0}/{1}/{2}?rev={3}'.format(
                 self.db_name, url_escape(doc['_id']),
                 url_escape(attachment_name), doc['_rev'])
-        r = yield self._http_delete(url)
+        try:
+            r = yield self._http_delete(url)
+        finally:
+            self._uncache([doc])
         raise gen.Return(r)
 
     @gen.coroutine
@@ -378,47 +962,602 @@ class AsyncCouch(object):
         r = yield self._view(url, body=view_doc, **kwargs)
         raise gen.Return(r)
 
+    def view_stream(self, design_doc_name, view_name, queue_size=1000,
+                    **kwargs):
+        """Query a pre-defined view in the specified design doc, streaming
+        the result rows.
+
+        Returns a `ViewStream`, delivering the rows one by one as they are
+        received and parsed, such that the response is never held in memory
+        as a whole. At most `queue_size` rows received are queued until
+        consumed. When the queue is full, the request is aborted, and the
+        query is resumed after the last queued row when the consumer has
+        caught up, using `startkey`, `startkey_docid` and `skip`. Rows
+        without an id, i.e. reduced rows, and the rows of queries with
+        `keys`, can not be resumed, and are queued without limit.
+        Accepts the same keyword parameters as `view()`.
+        """
+        url = '{0}/_design/{1}/_view/{2}'.format(
+            self.db_name, design_doc_name, view_name)
+        return self._view_stream(url, queue_size, kwargs)
+
+    def view_all_docs_stream(self, queue_size=1000, **kwargs):
+        """Query the _all_docs view, streaming the result rows.
+        Accepts the same keyword parameters as `view()`, and returns a
+        `ViewStream` like `view_stream()`.
+        """
+        url = '{0}/_all_docs'.format(self.db_name)
+        return self._view_stream(url, queue_size, kwargs)
+
+    def view_paged(self, design_doc_name, view_name, page_size=1000,
+                   **kwargs):
+        """Query a pre-defined view in the specified design doc, fetching
+        the result in pages of `page_size` rows.
+
+        Returns a `RowStream` of the result rows. The pages are requested
+        using `startkey` and `startkey_docid` of the row following each page,
+        so every page is found by the database in the same time, unlike when
+        paging using `skip`. The next page is prefetched while the rows of
+        the current page are being consumed.
+
+        Accepts the same keyword parameters as `view()`, except `keys` and
+        `skip`. The `limit` parameter limits the total number of rows.
+        """
+        url = '{0}/_design/{1}/_view/{2}'.format(
+            self.db_name, design_doc_name, view_name)
+        return self._view_paged(url, page_size, kwargs)
+
+    def view_all_docs_paged(self, page_size=1000, **kwargs):
+        """Query the _all_docs view, fetching the result in pages of
+        `page_size` rows. Returns a `RowStream` like `view_paged()`.
+        """
+        url = '{0}/_all_docs'.format(self.db_name)
+        return self._view_paged(url, page_size, kwargs, by_docid=False)
+
+    #
+    # Mango queries and indexes
+    #
+
+    @gen.coroutine
+    def find(self, selector, fields=None, sort=None, limit=None,
+             use_index=None, execution_stats=False, **kwargs):
+        """Query documents using a Mango `selector`.
+
+        The `fields` of the docs to return, the `sort` order, e.g.
+        ``[{'year': 'desc'}]``, the `limit` on the number of docs and the
+        index to use, `use_index`, are optional. Other keyword arguments
+        are passed in the query, e.g. `skip` or `bookmark`. Response is a
+        dict with the `docs`, and the `bookmark` of the next page. The
+        `execution_stats` of the query are included, if requested, and a
+        `warning` if no index matched the query.
+        """
+        r = yield self._find(self._find_query(
+            selector, fields, sort, limit, use_index, execution_stats,
+            kwargs))
+        raise gen.Return(r)
+
+    def find_paged(self, selector, page_size=1000, **kwargs):
+        """Query documents using a Mango `selector`, fetching the result in
+        pages of `page_size` docs.
+
+        Returns a `FindStream` of the docs. The pages are requested using
+        the `bookmark` of the previous page, and the next page is prefetched
+        while the docs of the current page are being consumed. Accepts the
+        same keyword parameters as `find()`, except `skip`. The `limit`
+        parameter limits the total number of docs.
+        """
+        if 'skip' in kwargs:
+            raise ValueError('Paged find does not accept skip')
+        query = self._find_query(
+            selector, kwargs.pop('fields', None), kwargs.pop('sort', None),
+            None, kwargs.pop('use_index', None),
+            kwargs.pop('execution_stats', False), kwargs)
+        stream = FindStream(page_size)
+        self._run_find_paged(stream, query, page_size)
+        return stream
+
     @gen.coroutine
-    def _view(self, url, **kwargs):
-        body = kwargs.get('body', {})
-        options = []
-        if kwargs:
-            for key, value in kwargs.items():
-                if key == 'body':
+    def explain(self, selector, fields=None, sort=None, limit=None,
+                use_index=None, **kwargs):
+        """Get the query plan of a Mango query, as made by `find()` with the
+        same parameters. The `index` of the plan is of type 'special' for a
+        full scan of the _all_docs index."""
+        url = '{0}/_explain'.format(self.db_name)
+        query = self._find_query(selector, fields, sort, limit, use_index,
+                                 False, kwargs)
+        r = yield self._http_post(url, self._encode(query))
+        raise gen.Return(r)
+
+    @gen.coroutine
+    def create_index(self, fields, ddoc=None, name=None, type='json',
+                     partial_filter_selector=None):
+        """Create a Mango index of the `fields`, e.g. ``['year', 'title']``
+        or ``[{'year': 'desc'}]``. The index is created in the design doc
+        `ddoc` with the `name`, if given, else these are generated. Response
+        is a dict with the `result`, 'created' or 'exists', and the `id` and
+        `name` of the index."""
+        index = {'fields': fields}
+        if partial_filter_selector is not None:
+            index['partial_filter_selector'] = partial_filter_selector
+        body = {'index': index, 'type': type}
+        if ddoc is not None:
+            body['ddoc'] = ddoc
+        if name is not None:
+            body['name'] = name
+        url = '{0}/_index'.format(self.db_name)
+        r = yield self._http_post(url, self._encode(body))
+        raise gen.Return(r)
+
+    @gen.coroutine
+    def list_indexes(self):
+        """List the Mango indexes of the database, including the special
+        _all_docs index."""
+        r = yield self._http_get('{0}/_index'.format(self.db_name))
+        raise gen.Return(r['indexes'])
+
+    @gen.coroutine
+    def delete_index(self, ddoc, name, type='json'):
+        """Delete the Mango index `name` in the design doc `ddoc`."""
+        if ddoc.startswith('_design/'):
+            ddoc = ddoc[8:]
+        url = '{0}/_index/{1}/{2}/{3}'.format(
+            self.db_name, url_escape(ddoc), type, url_escape(name))
+        r = yield self._http_delete(url)
+        raise gen.Return(r)
+
+    def _find_query(self, selector, fields, sort, limit, use_index,
+                    execution_stats, kwargs):
+        # make the body of a Mango query, leaving out unset parameters
+        query = dict(kwargs, selector=selector)
+        for key, value in (('fields', fields), ('sort', sort),
+                           ('limit', limit), ('use_index', use_index)):
+            if value is not None:
+                query[key] = value
+        if execution_stats:
+            query['execution_stats'] = True
+        return query
+
+    @gen.coroutine
+    def _find(self, query):
+        # a coroutine, for the request to start when called, also when
+        # _http_post is a native coroutine
+        url = '{0}/_find'.format(self.db_name)
+        r = yield self._http_post(url, self._encode(query))
+        raise gen.Return(r)
+
+    @gen.coroutine
+    def _run_find_paged(self, stream, query, page_size):
+        remaining = query.pop('limit', None)
+        try:
+            size = page_size if remaining is None else \
+                min(page_size, remaining)
+            page = self._find(dict(query, limit=size))
+            while page is not None:
+                r = yield page
+                page = None
+                stream._add_page(r)
+                docs = r['docs']
+                if remaining is not None:
+                    remaining -= len(docs)
+                if len(docs) == size and (remaining is None or remaining):
+                    size = page_size if remaining is None else \
+                        min(page_size, remaining)
+                    page = self._find(dict(query, limit=size,
+                                           bookmark=r['bookmark']))
+                for doc in docs:
+                    yield stream._put_wait(doc)
+        except _StreamClosed:
+            pass
+        except Exception as e:
+            stream._finish(e)
+            return
+        stream._finish()
+
+    @gen.coroutine
+    def _bulk_load(self, items, new_edits, chunk_size, chunk_bytes,
+                   concurrency, on_saved, on_error, on_progress):
+        # save the encoded docs of the (doc id, doc) items in chunks
+        url = '{0}/_bulk_docs'.format(self.db_name)
+        end = b']}' if new_edits else b'],"new_edits":false}'
+        start = time.time()
+        stats = {'docs': 0, 'errors': 0, 'bytes': 0, 'seconds': 0.0,
+                 'docs_per_sec': 0.0, 'mb_per_sec': 0.0}
+        chunks = queues.Queue(maxsize=concurrency)
+        failures = []
+
+        def update_stats():
+            stats['seconds'] = seconds = max(time.time() - start, 1e-6)
+            stats['docs_per_sec'] = stats['docs'] / seconds
+            stats['mb_per_sec'] = stats['bytes'] / seconds / 1048576
+
+        @gen.coroutine
+        def save_chunks():
+            while True:
+                chunk = yield chunks.get()
+                if chunk is None:
+                    return
+                if failures:
                     continue
-                if key == 'keys':
-                    body.update({'keys': value})
-                else:
-                    value = url_escape(
-                        value if key in ('startkey_docid', 'endkey_docid')
-                        else json_encode(value))
-                    options.append('='.join([key, value]))
+                doc_ids, parts = chunk
+                body = b''.join([b'{"docs":[', b','.join(parts), end])
+                # saving docs with ids, or existing revisions, is
+                # idempotent, and may be retried
+                idempotent = not new_edits or None not in doc_ids
+                try:
+                    rows = yield self._http_post(
+                        url, body, check_errors=False, idempotent=idempotent)
+                    # without new edits, there are only results for errors
+                    saved = len(doc_ids)
+                    for row in rows:
+                        if 'error' in row:
+                            saved -= 1
+                            stats['errors'] += 1
+                            if on_error is not None:
+                                on_error(row)
+                        elif on_saved is not None:
+                            on_saved(row)
+                    stats['docs'] += saved
+                    stats['bytes'] += len(body)
+                    update_stats()
+                    if on_progress is not None:
+                        on_progress(dict(stats))
+                except Exception as e:
+                    # a failing request or callback ends the load, while
+                    # the worker keeps taking the queued chunks
+                    failures.append(e)
+                finally:
+                    self._uncache_ids(doc_ids)
+
+        workers = [save_chunks() for _ in range(concurrency)]
+        try:
+            doc_ids, parts, size = [], [], 0
+            for doc_id, part in items:
+                if failures:
+                    break
+                if parts and (len(parts) == chunk_size or
+                              size + len(part) > chunk_bytes):
+                    yield chunks.put((doc_ids, parts))
+                    doc_ids, parts, size = [], [], 0
+                doc_ids.append(doc_id)
+                parts.append(part)
+                size += len(part) + 1
+            if parts and not failures:
+                yield chunks.put((doc_ids, parts))
+        finally:
+            for _ in workers:
+                yield chunks.put(None)
+            yield workers
+        if failures:
+            raise failures[0]
+        update_stats()
+        raise gen.Return(stats)
+
+    @gen.coroutine
+    def _sample_ids(self, partitions):
+        # sample the doc ids splitting the database in equal partitions
+        url = '{0}/_all_docs'.format(self.db_name)
+        total = (yield self._view(url, limit=0))['total_rows']
+        pages = yield [self._view(url, skip=total * i // partitions, limit=1)
+                       for i in range(1, partitions)]
+        raise gen.Return(sorted(set(page['rows'][0]['id'] for page in pages
+                                    if page['rows'])))
+
+    def _view_request(self, url, kwargs):
+        # make view url with query parameters, and the body (if any)
+        body = dict(kwargs.get('body', {}))
+        options = []
+        for key, value in kwargs.items():
+            if key == 'body':
+                continue
+            if key == 'keys':
+                body.update({'keys': value})
+            else:
+                value = url_escape(
+                    value if key in ('startkey_docid', 'endkey_docid')
+                    else json_encode(value))
+                options.append('='.join([key, value]))
         if options:
             url = '{0}?{1}'.format(url, '&'.join(options))
-        if body:
-            r = yield self._http_post(url, json_encode(body))
+        return url, (self._encode(body) if body else None)
+
+    @gen.coroutine
+    def _view(self, url, **kwargs):
+        url, body = self._view_request(url, kwargs)
+        if body is not None:
+            r = yield self._http_post(url, body)
         else:
             r = yield self._http_get(url)
         raise gen.Return(r)
 
+    def _view_stream(self, url, queue_size, kwargs):
+        stream = ViewStream(queue_size)
+        # rows of queries with keys can not be resumed
+        stream._resumable = 'keys' not in kwargs
+        self._run_view_stream(stream, url, kwargs)
+        return stream
+
+    def _view_paged(self, url, page_size, kwargs, by_docid=True):
+        if 'keys' in kwargs or 'skip' in kwargs:
+            raise ValueError('Paged view query does not accept keys or skip')
+        stream = RowStream(page_size)
+        self._run_view_paged(stream, url, page_size, by_docid, kwargs)
+        return stream
+
+    @gen.coroutine
+    def _run_view_paged(self, stream, url, page_size, by_docid, params):
+        remaining = params.pop('limit', None)
+        try:
+            # fetch one row more than the page size, to get the start of the
+            # next page
+            page = self._view(url, limit=page_size + 1, **params)
+            while page is not None:
+                rows = (yield page)['rows']
+                page = None
+                if len(rows) > page_size and (
+                        remaining is None or remaining > page_size):
+                    first = rows.pop()
+                    params['startkey'] = first['key']
+                    if by_docid and 'id' in first:
+                        params['startkey_docid'] = first['id']
+                    page = self._view(url, limit=page_size + 1, **params)
+                if remaining is not None:
+                    rows = rows[:remaining]
+                    remaining -= len(rows)
+                for row in rows:
+                    yield stream._put_wait(row)
+        except _StreamClosed:
+            pass
+        except Exception as e:
+            stream._finish(e)
+            return
+        stream._finish()
+
+    @gen.coroutine
+    def _run_view_stream(self, stream, url, params):
+        limit = params.get('limit')
+        try:
+            while True:
+                queued = stream._rows
+                view_url, body = self._view_request(url, params)
+                parser = _RowParser(b'"rows"', stream._put_row, self._decode)
+                try:
+                    yield self._http_stream(view_url, parser.feed, body=body)
+                except Exception:
+                    if not stream._full:
+                        raise
+                if not stream._full:
+                    break
+                # aborted, as the consumer is behind, resume after the last
+                # queued row when it has caught up
+                stream._full = False
+                key, doc_id = stream._last
+                params = dict(params, startkey=key, startkey_docid=doc_id,
+                              skip=stream._repeats)
+                params.pop('start_key', None)
+                params.pop('start_key_doc_id', None)
+                if limit is not None:
+                    params['limit'] = limit - stream._rows
+                yield stream._wait_room()
+            stream._set_meta(parser.close(), queued)
+        except Exception as e:
+            # the request of a closed stream fails when aborted
+            if not stream.closed:
+                stream._finish(e)
+            return
+        stream._finish()
+
+    def _batch_write(self, body):
+        # add the JSON encoded doc to the batch of docs for the database,
+        # returns a Future for the result of saving the doc
+        future = Future()
+        batch = self._write_batches.get(self.db_name)
+        if batch is None:
+            io_loop = self.io_loop or tornado.ioloop.IOLoop.current()
+            timeout = io_loop.call_later(
+                self.batch_delay, self._flush_writes, self.db_name)
+            batch = self._write_batches[self.db_name] = ([], timeout)
+        batch[0].append((body, future))
+        if len(batch[0]) >= self.batch_size:
+            self._flush_writes(self.db_name)
+        return future
+
+    @gen.coroutine
+    def _flush_writes(self, db_name):
+        batch = self._write_batches.pop(db_name, None)
+        if batch is None:
+            return
+        docs, timeout = batch
+        io_loop = self.io_loop or tornado.ioloop.IOLoop.current()
+        io_loop.remove_timeout(timeout)
+        url = '{0}/_bulk_docs'.format(db_name)
+        body = b''.join([b'{"docs":[', b','.join(utf8(doc) for doc, _ in docs),
+                         b']}'])
+        try:
+            rows = yield self._http_post(url, body, check_errors=False)
+        except Exception as e:
+            for _, future in docs:
+                future.set_exception(e)
+            return
+        for (_, future), row in zip(docs, rows):
+            if 'error' in row:
+                future.set_exception(relax_exception(httpclient.HTTPError(
+                    _error_code(row['error']), row.get('reason'))))
+            else:
+                row.setdefault('ok', True)
+                future.set_result(row)
+
+    @gen.coroutine
+    def _get_docs_chunk(self, doc_ids, missing):
+        # get docs, where missing and deleted docs are `missing`, or if
+        # `missing` is 'raise', deleted docs are None and missing docs raise
+        # NotFound
+        if self.cache is not None:
+            docs, unknown = yield self._get_docs_cached(doc_ids)
+        else:
+            url = '{0}/_all_docs?include_docs=true'.format(self.db_name)
+            body = self._encode({'keys': doc_ids})
+            r = yield self._http_post(url, body, check_errors=False)
+            docs = [row.get('doc') for row in r['rows']]
+            unknown = set(row['key'] for row in r['rows'] if 'error' in row)
+        for i, doc in enumerate(docs):
+            if doc is None:
+                if missing != 'raise':
+                    docs[i] = missing
+                elif doc_ids[i] in unknown:
+                    raise relax_exception(httpclient.HTTPError(
+                        404, 'not_found: {0}'.format(doc_ids[i])))
+        raise gen.Return(docs)
+
+    @gen.coroutine
+    def _get_doc_cached(self, doc_id):
+        key = (self.db_name, doc_id)
+        entry = self.cache.lookup(key)
+        if entry is None and self.batch_reads and \
+                not doc_id.startswith('_local/'):
+            doc = yield self._batch_read(doc_id)
+            self.cache.put(key, '"{0}"'.format(doc['_rev']),
+                           self._encode(doc))
+            raise gen.Return(doc)
+        if entry is not None and entry[2]:
+            raise gen.Return(self._decode(entry[1]))
+        url = '{0}/{1}'.format(self.db_name, url_escape(doc_id))
+        headers = {'Accept': 'application/json'}
+        if entry is not None:
+            # conditional request, if the cached doc is outdated
+            headers['If-None-Match'] = entry[0]
+        resp = yield self._http_get_response(url, headers)
+        if resp.code == 304:
+            self.cache.touch(key)
+            raise gen.Return(self._decode(entry[1]))
+        doc = self._parse_response(resp)
+        self.cache.put(key, resp.headers.get('ETag'), resp.body)
+        raise gen.Return(doc)
+
+    @gen.coroutine
+    def _get_docs_cached(self, doc_ids):
+        cached = {}
+        outdated = {}
+        for doc_id in doc_ids:
+            entry = self.cache.lookup((self.db_name, doc_id))
+            if entry is not None:
+                (cached if entry[2] else outdated)[doc_id] = entry
+        if outdated:
+            # get the current revisions of outdated docs
+            url = '{0}/_all_docs'.format(self.db_name)
+            body = self._encode({'keys': list(outdated)})
+            r = yield self._http_post(url, body, check_errors=False)
+            for row in r['rows']:
+                entry = outdated[row['key']]
+                if 'value' in row and not row['value'].get('deleted') and \
+                        entry[0] == '"{0}"'.format(row['value']['rev']):
+                    self.cache.touch((self.db_name, row['key']))
+                    cached[row['key']] = entry
+        docs = {}
+        unknown = set()
+        missing = [doc_id for doc_id in doc_ids if doc_id not in cached]
+        if missing:
+            url = '{0}/_all_docs?include_docs=true'.format(self.db_name)
+            body = self._encode({'keys': missing})
+            r = yield self._http_post(url, body, check_errors=False)
+            for row in r['rows']:
+                # missing and deleted docs are None
+                doc = docs[row['key']] = row.get('doc')
+                if 'error' in row:
+                    unknown.add(row['key'])
+                if doc is not None:
+                    self.cache.put((self.db_name, row['key']),
+                                   '"{0}"'.format(doc['_rev']),
+                                   self._encode(doc))
+        raise gen.Return(([docs[doc_id] if doc_id in docs
+                           else self._decode(cached[doc_id][1])
+                           for doc_id in doc_ids], unknown))
+
+    def _uncache(self, docs):
+        # invalidate cached docs, after saving or deleting them
+        if self.cache is not None:
+            self._uncache_ids(doc['_id'] for doc in docs if '_id' in doc)
+
+    def _uncache_ids(self, doc_ids):
+        if self.cache is not None:
+            for doc_id in doc_ids:
+                if doc_id is not None:
+                    self.cache.invalidate((self.db_name, doc_id))
+
+    def _batch_read(self, doc_id):
+        # add the doc id to the batch of ids to get from the database,
+        # returns a Future for the doc. Concurrent calls for the same doc
+        # share the request, each getting a Future of its own
+        key = (self.db_name, doc_id)
+        futures = self._read_futures.get(key)
+        if futures is None:
+            futures = self._read_futures[key] = []
+            batch = self._read_batches.get(self.db_name)
+            if batch is None:
+                batch = self._read_batches[self.db_name] = []
+                io_loop = self.io_loop or tornado.ioloop.IOLoop.current()
+                io_loop.add_callback(self._flush_reads, self.db_name)
+            batch.append(doc_id)
+        future = Future()
+        futures.append(future)
+        return future
+
+    @gen.coroutine
+    def _flush_reads(self, db_name):
+        doc_ids = self._read_batches.pop(db_name)
+        docs = error = None
+        try:
+            if len(doc_ids) == 1:
+                url = '{0}/{1}'.format(db_name, url_escape(doc_ids[0]))
+                docs = [(yield self._http_get(url))]
+            else:
+                url = '{0}/_all_docs?include_docs=true'.format(db_name)
+                body = self._encode({'keys': doc_ids})
+                r = yield self._http_post(url, body, check_errors=False)
+                docs = [row.get('doc') for row in r['rows']]
+        except Exception as e:
+            error = e
+        for i, doc_id in enumerate(doc_ids):
+            # calls made while the request was in flight are included
+            futures = self._read_futures.pop((db_name, doc_id))
+            for j, future in enumerate(futures):
+                if error is not None:
+                    future.set_exception(error)
+                elif docs[i] is None:
+                    # missing or deleted doc
+                    future.set_exception(relax_exception(
+                        httpclient.HTTPError(404, 'not_found')))
+                else:
+                    # each call gets a doc of its own, as it may modify it
+                    future.set_result(docs[i] if j == 0
+                                      else copy.deepcopy(docs[i]))
+
     #
     # Basic http methods and utility functions
     #
 
-    def _parse_response(self, resp):
+    def _parse_response(self, resp, check_errors=True):
         # decode the JSON body and check for errors
-        obj = json_decode(resp.body)
+        if self.instrument is not None and hasattr(resp, '_request_info'):
+            start = time.time()
+            try:
+                obj = self._decode(resp.body)
+            finally:
+                resp._request_info.decode_time = time.time() - start
+                self._end_request(resp._request_info, resp)
+        else:
+            obj = self._decode(resp.body)
 
-        def to_code(err):
-            return {'not_found': 404, 'conflict': 409}.get(err, 400)
+        if not check_errors and resp.code < 300:
+            # errors in the list of dicts or rows are handled by the caller
+            pass
 
-        if isinstance(obj, list):
+        elif isinstance(obj, list):
             # check if there is an error in the list of dicts,
             # raise the first error seen
             for item in obj:
                 if 'error' in item:
                     raise relax_exception(httpclient.HTTPError(
-                        to_code(item['error']), item['reason'], resp))
+                        _error_code(item['error']), item['reason'], resp))
 
         elif 'error' in obj:
             raise relax_exception(httpclient.HTTPError(
@@ -430,10 +1569,12 @@ class AsyncCouch(object):
             for row in obj['rows']:
                 if 'error' in row:
                     raise relax_exception(httpclient.HTTPError(
-                        to_code(row['error']), row['error'], resp))
+                        _error_code(row['error']), row['error'], resp))
         return obj
 
     def _parse_headers(self, resp):
+        if self.instrument is not None and hasattr(resp, '_request_info'):
+            self._end_request(resp._request_info, resp)
         headers = {"code": resp.code}
         headers.update(resp.headers)
         return headers
@@ -443,96 +1584,356 @@ class AsyncCouch(object):
             raise CouchException('Database connection is closed.')
 
     @gen.coroutine
-    def _http_get(self, uri, headers=None):
-        self._test_closed()
-        if headers is None:
-            headers = {}
-        req_args = copy.deepcopy(self.request_args)
-        req_args.setdefault('headers', {}).update(headers)
-        if 'Accept' not in req_args['headers']:
-            req_args['headers']['Accept'] = 'application/json'
-            decode = True
-        else:
-            # not a JSON response, don't try to decode
-            decode = False
-        req = httpclient.HTTPRequest(self.couch_url + uri, method='GET',
-                                     **req_args)
+    def _run_changes(self, stream, feed, heartbeat, request_timeout, params):
         try:
-            resp = yield self._client.fetch(req)
-        except httpclient.HTTPError as e:
-            if not e.response:
-                raise relax_exception(e)
-            resp = e.response
-        raise gen.Return(self._parse_response(resp) if decode else resp.body)
+            while not stream.closed:
+                query = dict(params, feed=feed, since=stream.last_seq,
+                             heartbeat=heartbeat)
+                url = '{0}/_changes?{1}'.format(self.db_name,
+                                                _query_string(query))
+                if feed in ('longpoll', 'normal'):
+                    parser = _RowParser(b'"results"', stream._put_change,
+                                        self._decode)
+                else:
+                    parser = _LineParser(stream._put_change, self._decode)
+
+                def on_chunk(chunk, parser=parser):
+                    # abort the request of a closed feed on any data, also
+                    # on heartbeats, not to keep the connection
+                    if stream.closed:
+                        raise _StreamClosed()
+                    parser.feed(chunk)
+
+                # the feed is not limited, as it may be open indefinitely
+                try:
+                    yield self._http_stream(url, on_chunk, admit=False,
+                                            request_timeout=request_timeout)
+                except Exception:
+                    if not stream._full:
+                        raise
+                if stream._full:
+                    # aborted, as the consumer is behind, resume from the
+                    # last queued change when it has caught up
+                    stream._full = False
+                    yield stream._wait_room()
+                    continue
+                meta = parser.close()
+                if meta and 'last_seq' in meta:
+                    stream.last_seq = meta['last_seq']
+                if feed == 'normal':
+                    break
+                if feed == 'longpoll':
+                    yield stream._wait_room()
+        except Exception as e:
+            # the request of a closed feed fails when aborted
+            if not stream.closed:
+                stream._finish(e)
+            return
+        stream._finish()
+
+    def _make_templates(self):
+        # precompute the request arguments and headers for each method,
+        # the request arguments are treated as frozen configuration
+        args = dict(self.request_args)
+        headers = dict(self.pool.headers) if self.pool else {}
+        headers.update(args.pop('headers', None) or {})
+        json_headers = dict(headers)
+        json_headers.setdefault('Accept', 'application/json')
+        self._request_defaults = args
+        self._headers = {
+            'GET': json_headers,
+            'PUT': json_headers,
+            'POST': dict(headers, **{'Accept': 'application/json',
+                                     'Content-Type': 'application/json'}),
+            'DELETE': dict(headers, Accept='application/json'),
+            'HEAD': headers
+        }
+        # responses are not decoded, if Accept is set in the request args
+        self._decode_get = 'Accept' not in headers
+
+    def _request(self, method, uri, body=None, headers=None, kwargs=None,
+                 base_url=None):
+        # make a request from the template for the method, the headers are
+        # copied as they may be modified by the http client
+        req_headers = dict(self._headers[method])
+        if headers:
+            req_headers.update(headers)
+        args = self._request_defaults
+        if kwargs:
+            args = dict(args, **kwargs)
+        return httpclient.HTTPRequest((base_url or self.couch_url) + uri,
+                                      method=method, body=body,
+                                      headers=req_headers, **args)
 
     @gen.coroutine
-    def _http_post(self, uri, body, **kwargs):
+    def _fetch(self, method, uri, body=None, headers=None, idempotent=None,
+               admit=True, decode=False, **kwargs):
+        # make a request, returning the response, also on HTTP errors. The
+        # request is instrumented until the response is parsed, if the
+        # caller will `decode` it, else until the response is received
         self._test_closed()
-        req_args = copy.deepcopy(self.request_args)
-        req_args.update(kwargs)
-        req_args.setdefault('headers', {}).update({
-            'Accept': 'application/json',
-            'Content-Type': 'application/json'})
-        req = httpclient.HTTPRequest(self.couch_url + uri, method='POST',
-                                     body=body, **req_args)
+        info = None
+        if self.instrument is not None:
+            info = self._start_request(method, uri, body, kwargs)
+        read = method in ('GET', 'HEAD') or \
+            (method == 'POST' and _read_post.search(uri) is not None)
+        admission = None
+        if self.limiter is not None and admit:
+            admission = (self.priority or
+                         ('interactive' if read else 'batch'), not read)
         try:
-            resp = yield self._client.fetch(req)
-        except httpclient.HTTPError as e:
-            if not e.response:
-                raise relax_exception(e)
-            resp = e.response
-        raise gen.Return(self._parse_response(resp))
+            # streamed responses, e.g. changes feeds that are open for long
+            # and aborted when closed, are not retried, nor counted by the
+            # circuit breaker
+            if self.retry is not None and 'streaming_callback' not in kwargs:
+                if idempotent is None:
+                    idempotent = read or method in ('PUT', 'DELETE')
+                resp = yield self._fetch_retry(method, uri, body, headers,
+                                               idempotent, admission, kwargs,
+                                               info)
+            else:
+                resp = yield self._fetch_once(method, uri, body, headers,
+                                              kwargs, admission, info)
+        except Exception as e:
+            if info is not None:
+                self._end_request(info, error=e)
+            raise
+        if info is not None:
+            if decode:
+                resp._request_info = info
+            else:
+                self._end_request(info, resp)
+        raise gen.Return(resp)
+
+    def _start_request(self, method, uri, body, kwargs):
+        # make the info of an instrumented request, counting the bytes of a
+        # streamed response as they are received
+        info = RequestInfo(method, uri)
+        if isinstance(body, (bytes, type(u''))):
+            info.request_bytes = len(utf8(body))
+        callback = kwargs.get('streaming_callback')
+        if callback is not None:
+            def count(chunk):
+                info.response_bytes += len(chunk)
+                callback(chunk)
+            kwargs['streaming_callback'] = count
+        self.instrument.before_request(info)
+        return info
+
+    def _end_request(self, info, resp=None, error=None):
+        # complete the info of an instrumented request, only once
+        if info.elapsed is not None:
+            return
+        info.elapsed = time.time() - info.start
+        if resp is not None:
+            info.status = resp.code
+            if resp.body:
+                info.response_bytes += len(resp.body)
+        else:
+            info.status = getattr(error, 'code', 599)
+            info.error = error
+        self.instrument.after_request(info)
 
     @gen.coroutine
-    def _http_put(self, uri, body='', headers=None):
-        self._test_closed()
-        if headers is None:
-            headers = {}
-        req_args = copy.deepcopy(self.request_args)
-        req_args.setdefault('headers', {}).update(headers)
-        if body and 'Content-Type' not in req_args['headers']:
-            req_args['headers']['Content-Type'] = 'application/json'
-        if 'Accept' not in req_args['headers']:
-            req_args['headers']['Accept'] = 'application/json'
-        req = httpclient.HTTPRequest(self.couch_url + uri, method='PUT',
-                                     body=body, **req_args)
+    def _fetch_retry(self, method, uri, body, headers, idempotent, admission,
+                     kwargs, info=None):
+        # make a request, retrying idempotent requests on failures using
+        # the retry policy
+        policy = self.retry
+        if not policy._allow():
+            raise CircuitOpen(httpclient.HTTPError(503))
+        timeout = kwargs.get('request_timeout',
+                             self._request_defaults.get('request_timeout'))
+        deadline = None
+        # requests without a timeout (0) may take any time
+        if policy.deadline is not None and timeout != 0:
+            deadline = time.time() + policy.deadline
+        attempt = 0
+        while True:
+            if deadline is not None:
+                # the request may not time out after the deadline
+                remaining = deadline - time.time()
+                kwargs = dict(kwargs, request_timeout=min(
+                    remaining, timeout or remaining))
+            resp = error = None
+            try:
+                resp = yield self._fetch_once(method, uri, body, headers,
+                                              kwargs, admission, info)
+            except (httpclient.HTTPError, IOError) as e:
+                error = e
+            finally:
+                # recorded also on other exceptions, not to leave the trial
+                # request of the circuit breaker pending
+                failed = resp is None or resp.code in policy.codes
+                policy._record(failed)
+            if not failed or not idempotent:
+                break
+            delay = policy._backoff(attempt)
+            if attempt == policy.max_retries or (
+                    deadline is not None and
+                    time.time() + delay >= deadline) or not policy._allow():
+                policy.exhausted += 1
+                break
+            attempt += 1
+            policy.retries += 1
+            yield gen.sleep(delay)
+        if resp is None:
+            raise error
+        raise gen.Return(resp)
+
+    @gen.coroutine
+    def _fetch_once(self, method, uri, body, headers, kwargs, admission=None,
+                    info=None):
+        # make a request to the database, or the cluster, once admitted by
+        # the limiter, given the priority and whether it is a write
+        if admission is not None:
+            start = time.time()
+            yield self.limiter._acquire(*admission)
+            if info is not None:
+                info.queue_time += time.time() - start
+        if info is not None:
+            start = time.time()
         try:
-            resp = yield self._client.fetch(req)
-        except httpclient.HTTPError as e:
-            if not e.response:
-                raise relax_exception(e)
-            resp = e.response
+            if self.cluster is not None:
+                resp = yield self._fetch_cluster(method, uri, body, headers,
+                                                 kwargs)
+            else:
+                req = self._request(method, uri, body, headers, kwargs)
+                try:
+                    resp = yield self._client.fetch(req)
+                except httpclient.HTTPError as e:
+                    if not e.response:
+                        raise relax_exception(e)
+                    resp = e.response
+        finally:
+            if info is not None:
+                info.network_time += time.time() - start
+            if admission is not None:
+                self.limiter._release()
+        raise gen.Return(resp)
+
+    @gen.coroutine
+    def _fetch_cluster(self, method, uri, body, headers, kwargs):
+        # make a request to the selected node of the cluster, retrying
+        # idempotent requests on other nodes, on connection errors and on
+        # responses from unavailable nodes
+        cluster = self.cluster
+        if cluster.health_interval is not None and \
+                time.time() >= cluster._next_check:
+            cluster._next_check = time.time() + cluster.health_interval
+            io_loop = self.io_loop or tornado.ioloop.IOLoop.current()
+            io_loop.add_callback(self._check_health, cluster)
+        # partly streamed responses are not retried
+        retry = (method in ('GET', 'HEAD') or (
+            method == 'POST' and _read_post.search(uri) is not None)) and \
+            'streaming_callback' not in kwargs
+        tried = []
+        while True:
+            node = cluster.select(tried)
+            req = self._request(method, uri, body, headers, kwargs, node.url)
+            node.outstanding += 1
+            start = time.time()
+            try:
+                resp = yield self._client.fetch(req)
+                error = None
+            except (httpclient.HTTPError, IOError) as e:
+                resp = getattr(e, 'response', None)
+                error = e
+            finally:
+                node.outstanding -= 1
+            failed = resp is None or resp.code in (502, 503, 504)
+            node._record(None if resp is None else time.time() - start,
+                         failed or resp.code >= 500,
+                         cluster.eject_time if failed else None)
+            tried.append(node)
+            if not failed or not retry or len(tried) == len(cluster.nodes):
+                break
+        if resp is None:
+            if not isinstance(error, httpclient.HTTPError):
+                error = httpclient.HTTPError(599, str(error))
+            raise relax_exception(error)
+        raise gen.Return(resp)
+
+    @gen.coroutine
+    def _check_health(self, cluster):
+        # probe each node of the cluster, a node is unavailable while
+        # failing the probe
+        @gen.coroutine
+        def probe(node):
+            req = self._request('GET', '_up', kwargs={
+                'request_timeout': cluster.health_timeout}, base_url=node.url)
+            try:
+                yield self._client.fetch(req)
+                node.healthy = True
+                node.ejected_until = 0
+            except Exception:
+                node.healthy = False
+        if not self._closed:
+            yield [probe(node) for node in cluster.nodes]
+
+    @gen.coroutine
+    def _http_stream(self, uri, streaming_callback, body=None, headers=None,
+                     **kwargs):
+        # make a request and pass the response body in chunks to the
+        # streaming callback, as they are received
+        status = []
+
+        def header_callback(line):
+            if not status and line.startswith('HTTP/'):
+                status.append(httputil.parse_response_start_line(
+                    line.strip()).code)
+
+        def on_chunk(chunk):
+            # error responses are not passed on to the callback
+            if status and status[0] < 300:
+                streaming_callback(chunk)
+
+        resp = yield self._fetch(
+            'GET' if body is None else 'POST', uri, body, headers,
+            header_callback=header_callback, streaming_callback=on_chunk,
+            **kwargs)
+        if resp.code >= 300:
+            raise relax_exception(httpclient.HTTPError(
+                resp.code, resp.reason, resp))
+        raise gen.Return(resp)
+
+    @gen.coroutine
+    def _http_get(self, uri, headers=None):
+        if self._decode_get and not (headers and 'Accept' in headers):
+            resp = yield self._fetch('GET', uri, headers=headers, decode=True)
+            raise gen.Return(self._parse_response(resp))
+        resp = yield self._fetch('GET', uri, headers=headers)
+        # not a JSON response, don't try to decode
+        raise gen.Return(resp.body)
+
+    @gen.coroutine
+    def _http_get_response(self, uri, headers):
+        # make GET request, returning the response without decoding it
+        resp = yield self._fetch('GET', uri, headers=headers)
+        raise gen.Return(resp)
+
+    @gen.coroutine
+    def _http_post(self, uri, body, check_errors=True, **kwargs):
+        resp = yield self._fetch('POST', uri, body, decode=True, **kwargs)
+        raise gen.Return(self._parse_response(resp, check_errors))
+
+    @gen.coroutine
+    def _http_put(self, uri, body='', headers=None):
+        if body and 'Content-Type' not in self._headers['PUT'] and \
+                not (headers and 'Content-Type' in headers):
+            headers = dict(headers or {})
+            headers['Content-Type'] = 'application/json'
+        resp = yield self._fetch('PUT', uri, body, headers, decode=True)
         raise gen.Return(self._parse_response(resp))
 
     @gen.coroutine
     def _http_delete(self, uri):
-        self._test_closed()
-        req_args = copy.deepcopy(self.request_args)
-        req_args.setdefault('headers', {}).update({
-            'Accept': 'application/json'})
-        req = httpclient.HTTPRequest(self.couch_url + uri, method='DELETE',
-                                     **req_args)
-        try:
-            resp = yield self._client.fetch(req)
-        except httpclient.HTTPError as e:
-            if not e.response:
-                raise relax_exception(e)
-            resp = e.response
+        resp = yield self._fetch('DELETE', uri, decode=True)
         raise gen.Return(self._parse_response(resp))
 
     @gen.coroutine
     def _http_head(self, uri):
-        if self._closed:
-            raise CouchException('Database connection is closed.')
-        req_args = copy.deepcopy(self.request_args)
-        req = httpclient.HTTPRequest(self.couch_url + uri, method='HEAD',
-            **req_args)
-        try:
-            resp = yield self._client.fetch(req)
-        except httpclient.HTTPError as e:
-            if not e.response:
-                raise relax_exception(e)
-            resp = e.response
+        resp = yield self._fetch('HEAD', uri, decode=True)
         raise gen.Return(self._parse_headers(resp))
 
 
@@ -581,6 +1982,30 @@ class BlockingCouch(AsyncCouch):
         AsyncCouch.__init__(self, db_name, couch_url, io_loop=io_loop,
                             **request_args)
 
+    # methods returning a RowStream
+    _stream_methods = ('changes', 'view_stream', 'view_all_docs_stream',
+                       'view_paged', 'view_all_docs_paged', 'find_paged')
+
+    def db(self, db_name):
+        """Get a handle for the database `db_name`, see `AsyncCouch.db()`.
+        """
+        return BlockingDatabase(self, db_name)
+
+    def pipeline(self, concurrency=None):
+        """Get a `Pipeline` for making calls concurrently, e.g.::
+
+            with db.pipeline() as p:
+                for doc_id in doc_ids:
+                    p.get_doc(doc_id)
+            docs = p.results
+
+        Calls to methods of the pipeline are queued, and made concurrently,
+        at most `concurrency` at a time if given, on leaving the context or
+        calling `execute()`. The results are given in the order of the
+        calls, where the exception is given for any failed call.
+        """
+        return Pipeline(self, concurrency)
+
     def close(self):
         """Closes the CouchDB client, freeing any resources used."""
         if not self._closed:
@@ -594,11 +2019,21 @@ class BlockingCouch(AsyncCouch):
             raise AttributeError("'{}' object has no attribute '{}'".format(
                                  self.__class__.__name__, name))
 
-        if name == 'close' or name.startswith('_') or not hasattr(
-                attr, '__call__'):
+        if name in ('close', 'db', 'pipeline') or name.startswith('_') or \
+                not hasattr(attr, '__call__'):
             # a 'local' or internal attribute, or a non-callable
             return attr
 
+        if name in self._stream_methods:
+            # returns a stream, wrap it in a blocking iterator
+            def stream_wrapper(*args, **kwargs):
+                @gen.coroutine
+                def start():
+                    raise gen.Return(attr(*args, **kwargs))
+                stream = self.io_loop.run_sync(start)
+                return BlockingRowStream(stream, self.io_loop)
+            return stream_wrapper
+
         # it's an asynchronous callable
         # return a callable wrapper for the attribute that will
         # run in its own IOLoop
@@ -608,6 +2043,1406 @@ class BlockingCouch(AsyncCouch):
         return functools.partial(wrapper, attr)
 
 
+class Database(object):
+    """Handle for a database, made by `AsyncCouch.db()`.
+
+    All attributes, other than the database name `db_name`, are read from
+    the client making the handle, as `server`. The handle has the methods of
+    the client, except for `use()` and `close()`.
+    """
+
+    __slots__ = ('server', 'db_name')
+
+    def __init__(self, server, db_name):
+        self.server = server
+        self.db_name = db_name
+
+    def __getattr__(self, name):
+        if name in ('use', 'close'):
+            raise AttributeError("'{}' object has no attribute '{}'".format(
+                                 self.__class__.__name__, name))
+        return getattr(self.server, name)
+
+    def db(self, db_name):
+        """Get a handle for the database `db_name`."""
+        return self.server.db(db_name)
+
+
+# the handle uses the methods of AsyncCouch, with its own db_name
+for _name, _attr in list(vars(AsyncCouch).items()):
+    if inspect.isfunction(_attr) and not _name.startswith('__') and \
+            _name not in ('use', 'close', 'db', '_make_templates'):
+        setattr(Database, _name, _attr)
+
+
+class BlockingDatabase(Database):
+    """Handle for a database, made by `BlockingCouch.db()`."""
+
+    __slots__ = ()
+
+    __getattribute__ = vars(BlockingCouch)['__getattribute__']
+
+    pipeline = vars(BlockingCouch)['pipeline']
+
+
+class Pipeline(object):
+    """Calls queued for making them concurrently, made by
+    `BlockingCouch.pipeline()`.
+
+    The pipeline has the methods of the client, except for those returning a
+    stream, each returning the index of the call in the results.
+    """
+
+    def __init__(self, client, concurrency=None):
+        self.client = client
+        self.concurrency = concurrency
+        self.results = None
+        self._calls = []
+
+    def __getattr__(self, name):
+        if name.startswith('_') or name in BlockingCouch._stream_methods or \
+                name in ('use', 'close', 'db', 'pipeline'):
+            raise AttributeError("'{}' object has no attribute '{}'".format(
+                                 self.__class__.__name__, name))
+        # the asynchronous method of the client
+        attr = object.__getattribute__(self.client, name)
+
+        def queue(*args, **kwargs):
+            self._calls.append((attr, args, kwargs))
+            return len(self._calls) - 1
+        return queue
+
+    def execute(self):
+        """Make the queued calls, returns the results in the order of the
+        calls, where the exception is given for any failed call."""
+        calls, self._calls = self._calls, []
+        results = [None] * len(calls)
+        pending = iter(enumerate(calls))
+
+        @gen.coroutine
+        def make_calls():
+            for i, (method, args, kwargs) in pending:
+                try:
+                    results[i] = yield method(*args, **kwargs)
+                except Exception as e:
+                    results[i] = e
+
+        @gen.coroutine
+        def run():
+            n = len(calls)
+            if self.concurrency is not None:
+                n = min(n, self.concurrency)
+            yield [make_calls() for _ in range(n)]
+
+        self.client.io_loop.run_sync(run)
+        self.results = results
+        return results
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.execute()
+
+
+class ThreadedCouch(object):
+    """Thread-safe client for CouchDB, which may be shared between threads.
+
+    Example usage::
+
+        import couch
+
+        db = couch.ThreadedCouch('mytestdb')
+        future = db.get_doc('mydoc')
+        doc = future.result()
+
+    The calls are made by an `AsyncCouch` on an IOLoop running in a
+    background thread, shared by all ThreadedCouch clients, and return a
+    `concurrent.futures.Future` of the result, without blocking the calling
+    thread. Methods returning a `RowStream`, e.g. `changes()`, return a
+    blocking iterator of the rows, like `BlockingCouch`.
+
+    Requires Python 3, or the futures package on Python 2.
+    """
+
+    __slots__ = ('_client', '_loop')
+
+    def __init__(self, db_name='', couch_url='http://127.0.0.1:5984/',
+                 **kwargs):
+        """Creates a `ThreadedCouch`.
+
+        The parameters are those of `AsyncCouch`, except for `io_loop`.
+        Unless a `pool` is given, the clients share the `ConnectionPool` of
+        the background thread. A given `pool`, `cache`, `limiter` or `retry`
+        policy shall only be used by ThreadedCouch clients, as they are used
+        in the background thread.
+        """
+        self._loop = _LoopThread.get()
+        self._client = self._loop.submit(
+            self._loop.make_client, db_name, couch_url, kwargs).result()
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if name.startswith('_') or not callable(attr):
+            # an internal attribute, or a non-callable
+            return attr
+        if name in BlockingCouch._stream_methods:
+            # returns a stream, wrap it in a blocking iterator
+            def stream_wrapper(*args, **kwargs):
+                stream = self._loop.submit(attr, *args, **kwargs).result()
+                return ThreadedRowStream(stream, self._loop)
+            return stream_wrapper
+        return functools.partial(self._loop.submit, attr)
+
+    def db(self, db_name):
+        """Get a handle for the database `db_name`, see `AsyncCouch.db()`.
+        """
+        handle = object.__new__(ThreadedCouch)
+        handle._client = self._client.db(db_name)
+        handle._loop = self._loop
+        return handle
+
+    def close(self):
+        """Closes the CouchDB client, freeing any resources used. The
+        background thread keeps running, for use by other clients."""
+        if isinstance(self._client, AsyncCouch):
+            self._loop.submit(self._client.close).result()
+
+
+class _LoopThread(object):
+    """IOLoop running in a daemon thread, shared by the ThreadedCouch
+    clients, with the ConnectionPool they share by default."""
+
+    _instance = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def get(cls):
+        with cls._lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+
+    def __init__(self):
+        if futures is None:
+            raise ImportError('ThreadedCouch requires the futures package')
+        self.io_loop = tornado.ioloop.IOLoop(make_current=False)
+        self.pool = None
+        self.thread = threading.Thread(target=self.io_loop.start,
+                                       name='couch-ioloop')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, fn, *args, **kwargs):
+        """Call `fn` in the IOLoop thread, returns a concurrent Future of its
+        result, or of the result of the Future returned by `fn`."""
+        future = futures.Future()
+
+        def copy(result):
+            try:
+                future.set_result(result.result())
+            except Exception as e:
+                future.set_exception(e)
+
+        def run():
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                future.set_exception(e)
+                return
+            if isinstance(result, (Future, futures.Future)):
+                self.io_loop.add_future(result, copy)
+            else:
+                future.set_result(result)
+
+        self.io_loop.add_callback(run)
+        return future
+
+    def make_client(self, db_name, couch_url, kwargs):
+        # make the client in the IOLoop thread, where the HTTP client of
+        # the pool is bound to the IOLoop
+        if kwargs.get('pool') is None:
+            if self.pool is None:
+                self.pool = ConnectionPool()
+            kwargs = dict(kwargs, pool=self.pool)
+        return AsyncCouch(db_name, couch_url, **kwargs)
+
+
+class ConnectionPool(object):
+    """HTTP client, with its pool of connections, for use with one or more
+    `AsyncCouch` clients, e.g. one for each of a number of databases.
+
+    The HTTP client implementation `impl` is 'simple' (Tornado's
+    SimpleAsyncHTTPClient), 'curl' (CurlAsyncHTTPClient, requires pycurl),
+    an AsyncHTTPClient sub-class, or None for the configured default
+    implementation of AsyncHTTPClient. At most `max_clients` requests are
+    made concurrently, further requests are queued.
+
+    The `connect_timeout` and `request_timeout`, in seconds, are the
+    defaults for requests that do not set them. Note that the timeouts
+    include the time spent in the queue. Connections are kept alive between
+    requests by the curl client, unless `keep_alive` is False. The simple
+    client does not keep connections alive, and raises ValueError if
+    `keep_alive` is True. Other keyword arguments in `client_args` are
+    passed to the HTTP client, e.g. `max_body_size` of the simple client.
+
+    The pool shall be used on one IOLoop only, the given `io_loop`, or the
+    current IOLoop.
+    """
+
+    def __init__(self, impl=None, max_clients=10, connect_timeout=None,
+                 request_timeout=None, keep_alive=None, io_loop=None,
+                 **client_args):
+        from tornado.simple_httpclient import SimpleAsyncHTTPClient
+        if impl is None:
+            impl = httpclient.AsyncHTTPClient
+        elif impl == 'simple':
+            impl = SimpleAsyncHTTPClient
+        elif impl == 'curl':
+            from tornado.curl_httpclient import CurlAsyncHTTPClient
+            impl = CurlAsyncHTTPClient
+        if impl is httpclient.AsyncHTTPClient:
+            impl_class = impl.configured_class()
+        else:
+            impl_class = impl
+        if keep_alive and issubclass(impl_class, SimpleAsyncHTTPClient):
+            raise ValueError('The simple HTTP client does not keep '
+                             'connections alive')
+        defaults = {}
+        if connect_timeout is not None:
+            defaults['connect_timeout'] = connect_timeout
+        if request_timeout is not None:
+            defaults['request_timeout'] = request_timeout
+        # headers added to the requests of the clients using the pool
+        self.headers = {'Connection': 'close'} if keep_alive is False \
+            else {}
+        self.max_clients = max_clients
+        self.client = _http_client(impl, io_loop, max_clients=max_clients,
+                                   defaults=defaults, **client_args)
+
+    def close(self):
+        """Closes the HTTP client, after closing the clients using it."""
+        self.client.close()
+
+
+class Cluster(object):
+    """Nodes of a CouchDB cluster, for use as `couch_url` of a client.
+
+    The `urls` of the nodes should include port number and authentication
+    credentials as necessary. Requests are made to the available node with
+    the least outstanding requests, if `balance` is 'least_requests', or
+    the lowest expected latency, from the average latency and outstanding
+    requests, if `balance` is 'latency'.
+
+    A node is unavailable for `eject_time` seconds after a connection error
+    or a 502, 503 or 504 response, and while failing the health checks made
+    by requesting `/_up` of each node. Health checks are made at most once
+    every `health_interval` seconds, while requests are made, or never if it
+    is None. Idempotent requests, GET and HEAD, and POST requests for
+    reading, e.g. views with keys and Mango queries, failing on one node
+    are retried on the other nodes. If no node is available, requests are
+    made to any node.
+    """
+
+    def __init__(self, urls, balance='least_requests', health_interval=10.0,
+                 health_timeout=5.0, eject_time=30.0):
+        if not urls:
+            raise ValueError('no node urls given')
+        if balance not in ('least_requests', 'latency'):
+            raise ValueError('unknown balance {0!r}'.format(balance))
+        self.nodes = [_Node(url if url.endswith('/') else url + '/')
+                      for url in urls]
+        self.balance = balance
+        self.health_interval = health_interval
+        self.health_timeout = health_timeout
+        self.eject_time = eject_time
+        self._next_check = 0
+
+    def select(self, exclude=()):
+        """Select a node for making a request, not one of `exclude`."""
+        now = time.time()
+        nodes = [node for node in self.nodes if node not in exclude]
+        available = [node for node in nodes
+                     if node.healthy and node.ejected_until <= now]
+        if self.balance == 'latency':
+            key = _Node._expected_latency
+        else:
+            key = _Node._load
+        return min(available or nodes, key=key)
+
+    def stats(self):
+        """Get the stats of each node, as a list of dicts with the `url`,
+        the number of `requests`, `errors` and `outstanding` requests, the
+        moving average `latency` in seconds, and whether it is `available`.
+        """
+        now = time.time()
+        return [{'url': node.url, 'requests': node.requests,
+                 'errors': node.errors, 'outstanding': node.outstanding,
+                 'latency': node.latency,
+                 'available': node.healthy and node.ejected_until <= now}
+                for node in self.nodes]
+
+
+class _Node(object):
+    # a node of a cluster, with its request stats
+
+    __slots__ = ('url', 'outstanding', 'requests', 'errors', 'latency',
+                 'healthy', 'ejected_until')
+
+    # weight of the latest request in the moving average latency
+    alpha = 0.2
+
+    def __init__(self, url):
+        self.url = url
+        self.outstanding = 0
+        self.requests = 0
+        self.errors = 0
+        self.latency = 0.0
+        self.healthy = True
+        self.ejected_until = 0
+
+    def _load(self):
+        return (self.outstanding, self.latency)
+
+    def _expected_latency(self):
+        return ((self.outstanding + 1) * self.latency, self.outstanding)
+
+    def _record(self, seconds, error, eject_time=None):
+        self.requests += 1
+        if error:
+            self.errors += 1
+        # the latency of failed connections is not representative
+        if seconds is not None and self.latency:
+            self.latency += self.alpha * (seconds - self.latency)
+        elif seconds is not None:
+            self.latency = seconds
+        if eject_time is not None:
+            self.ejected_until = time.time() + eject_time
+
+
+class RetryPolicy(object):
+    """Policy for retrying failed requests, with a circuit breaker, for use
+    with one or more `AsyncCouch` clients.
+
+    A request fails on a connection error or timeout, or on a response with
+    a status code in `codes`. Failed requests using an idempotent method,
+    GET, HEAD, PUT or DELETE, and POST requests for reading, e.g. views with
+    keys, and saving or deleting docs with ids using the bulk docs API, are
+    retried at most `max_retries` times. Note that retrying a write that
+    was applied, though the request failed, gives a Conflict.
+
+    Before retrying, the client waits a random time up to `backoff` seconds,
+    doubling for each retry up to `max_backoff` seconds. No request is made
+    after `deadline` seconds from the call, if given, and the request
+    timeout is shortened to the deadline. Requests with a request timeout
+    of 0 (no timeout) have no deadline. Streamed responses, e.g. changes
+    feeds and view streams, are not retried, have no deadline, and are not
+    counted by the circuit breaker.
+
+    The circuit breaker opens, when at least `breaker_threshold` of the
+    requests in a window of `breaker_window` seconds fail, given at least
+    `breaker_min_requests` requests. While open, calls raise CircuitOpen
+    without making a request. After `breaker_timeout` seconds one trial
+    request is made, closing the breaker if it succeeds, else opening it
+    again.
+    """
+
+    def __init__(self, max_retries=3, backoff=0.1, max_backoff=5.0,
+                 deadline=None, codes=(500, 502, 503, 504),
+                 breaker_threshold=0.5, breaker_min_requests=20,
+                 breaker_window=10.0, breaker_timeout=30.0):
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.deadline = deadline
+        self.codes = frozenset(codes)
+        self.breaker_threshold = breaker_threshold
+        self.breaker_min_requests = breaker_min_requests
+        self.breaker_window = breaker_window
+        self.breaker_timeout = breaker_timeout
+        self.requests = 0
+        self.failures = 0
+        self.retries = 0
+        self.exhausted = 0
+        self.rejected = 0
+        self.trips = 0
+        self.state = 'closed'
+        self._window_end = 0
+        self._window_requests = 0
+        self._window_failures = 0
+        self._open_until = 0
+        self._trial = False
+
+    def stats(self):
+        """Get the counters of the policy as a dict, with the number of
+        `requests` made, `failures`, `retries`, calls failing after retrying
+        as `exhausted`, calls `rejected` by the open circuit breaker, and
+        `trips` of the breaker, and the `state` of the breaker, 'closed',
+        'open' or 'half_open'.
+        """
+        return {'requests': self.requests, 'failures': self.failures,
+                'retries': self.retries, 'exhausted': self.exhausted,
+                'rejected': self.rejected, 'trips': self.trips,
+                'state': self.state}
+
+    def _backoff(self, attempt):
+        # capped exponential backoff with full jitter
+        return random.uniform(
+            0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def _allow(self):
+        # whether a request may be made, by the circuit breaker
+        if self.state == 'open':
+            if time.time() < self._open_until:
+                self.rejected += 1
+                return False
+            self.state = 'half_open'
+            self._trial = False
+        if self.state == 'half_open':
+            if self._trial:
+                self.rejected += 1
+                return False
+            self._trial = True
+        return True
+
+    def _record(self, failed):
+        # record the outcome of a request
+        self.requests += 1
+        if failed:
+            self.failures += 1
+        if self.state == 'half_open':
+            if failed:
+                self._open()
+            else:
+                self.state = 'closed'
+                self._window_end = 0
+            return
+        now = time.time()
+        if now >= self._window_end:
+            self._window_end = now + self.breaker_window
+            self._window_requests = self._window_failures = 0
+        self._window_requests += 1
+        if failed:
+            self._window_failures += 1
+            if self.state == 'closed' and \
+                    self._window_requests >= self.breaker_min_requests and \
+                    self._window_failures >= \
+                    self.breaker_threshold * self._window_requests:
+                self._open()
+
+    def _open(self):
+        self.state = 'open'
+        self.trips += 1
+        self._open_until = time.time() + self.breaker_timeout
+
+
+class Limiter(object):
+    """Admission control of the requests of one or more `AsyncCouch`
+    clients.
+
+    At most `max_requests` requests are in flight, further requests wait in
+    a queue for their priority. Waiting 'interactive' requests are made
+    before waiting 'batch' requests. Writes are limited to `write_rate`
+    requests per second, if given, allowing bursts of `write_burst`
+    requests. The limiter shall be used on one IOLoop only.
+
+    For backpressure, the number of requests waiting and in flight are
+    given by `queued` and `in_flight`, and the moving average of the time
+    spent waiting before being admitted, in seconds, by `wait_time`.
+    """
+
+    # weight of the latest wait in the moving average wait time
+    alpha = 0.2
+
+    def __init__(self, max_requests=10, write_rate=None, write_burst=None):
+        self.max_requests = max_requests
+        self.write_rate = write_rate
+        self.write_burst = write_burst or max(1, write_rate or 0)
+        self.in_flight = 0
+        self.admitted = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+        self._queues = collections.OrderedDict(
+            [('interactive', collections.deque()),
+             ('batch', collections.deque())])
+        self._tokens = self.write_burst
+        self._refilled = time.time()
+
+    @property
+    def queued(self):
+        """Number of requests waiting to be admitted."""
+        return sum(len(queue) for queue in self._queues.values())
+
+    def stats(self):
+        """Get the stats of the limiter as a dict, with the number of
+        requests `in_flight`, `admitted`, and waiting for each priority in
+        `queued`, and the average and maximum time spent waiting,
+        `wait_time` and `max_wait`, in seconds.
+        """
+        return {'in_flight': self.in_flight, 'admitted': self.admitted,
+                'queued': dict((priority, len(queue)) for priority, queue
+                               in self._queues.items()),
+                'wait_time': self.wait_time, 'max_wait': self.max_wait}
+
+    @gen.coroutine
+    def _acquire(self, priority, write):
+        # wait for the request to be admitted
+        start = time.time()
+        if write and self.write_rate:
+            # take a token from the bucket, waiting for it, if there are no
+            # tokens left
+            self._tokens = min(self.write_burst, self._tokens +
+                               (start - self._refilled) * self.write_rate)
+            self._refilled = start
+            self._tokens -= 1
+            if self._tokens < 0:
+                yield gen.sleep(-self._tokens / self.write_rate)
+        if self.in_flight < self.max_requests:
+            self.in_flight += 1
+        else:
+            future = Future()
+            self._queues[priority].append(future)
+            # the request is given the place of a finished request
+            yield future
+        wait = time.time() - start
+        self.admitted += 1
+        self.wait_time += self.alpha * (wait - self.wait_time)
+        self.max_wait = max(self.max_wait, wait)
+
+    def _release(self):
+        # admit the next waiting request, by priority
+        for queue in self._queues.values():
+            if queue:
+                queue.popleft().set_result(None)
+                return
+        self.in_flight -= 1
+
+
+class RequestInfo(object):
+    """Info about a request made by an instrumented client, passed to the
+    hooks of an `Instrument`.
+
+    The `operation` is the name of the client method for the endpoint of
+    the request, e.g. 'get_doc', 'save_docs', 'view' or 'changes', and
+    `db_name` the database, or None. Requests of `get_docs()` are made to
+    the _all_docs view, and are named 'view_all_docs'.
+
+    After the request, `status` is the status code of the response, or of
+    the `error` raised, `request_bytes` and `response_bytes` are the sizes
+    of the bodies, and `elapsed` is the time of the call in seconds. Of the
+    elapsed time, `queue_time` was spent waiting for the limiter,
+    `network_time` making the request, including retries, and `decode_time`
+    decoding the JSON response.
+    """
+
+    __slots__ = ('operation', 'db_name', 'method', 'uri', 'start', 'status',
+                 'error', 'request_bytes', 'response_bytes', 'elapsed',
+                 'queue_time', 'network_time', 'decode_time')
+
+    def __init__(self, method, uri):
+        self.operation, self.db_name = _operation(method, uri)
+        self.method = method
+        self.uri = uri
+        self.start = time.time()
+        self.status = None
+        self.error = None
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.elapsed = None
+        self.queue_time = 0.0
+        self.network_time = 0.0
+        self.decode_time = 0.0
+
+
+# operations on the endpoints of a database, by the first path segment
+_db_operations = {'_bulk_docs': 'save_docs', '_all_docs': 'view_all_docs',
+                  '_temp_view': 'temp_view', '_changes': 'changes',
+                  '_find': 'find', '_explain': 'explain'}
+
+# operations on the Mango indexes of a database, by method
+_index_operations = {'GET': 'list_indexes', 'POST': 'create_index',
+                     'DELETE': 'delete_index'}
+
+# operations on the endpoints of the server
+_server_operations = {'_all_dbs': 'list_dbs', '_uuids': 'uuids',
+                      '_replicate': 'pull_db', '_up': 'health_check'}
+
+# operations on databases, documents and attachments, by method
+_method_operations = (
+    {'GET': 'info_db', 'PUT': 'create_db', 'DELETE': 'delete_db',
+     'POST': 'save_doc', 'HEAD': 'info_db'},
+    {'GET': 'get_doc', 'PUT': 'save_doc', 'DELETE': 'delete_doc',
+     'HEAD': 'has_doc'},
+    {'GET': 'get_attachment', 'PUT': 'save_attachment',
+     'DELETE': 'delete_attachment', 'HEAD': 'get_attachment'})
+
+
+def _operation(method, uri):
+    """Get the operation name and the database name of a request."""
+    parts = uri.split('?', 1)[0].split('/')
+    if parts[0].startswith('_'):
+        return _server_operations.get(parts[0], parts[0][1:]), None
+    if len(parts) > 1 and parts[1].startswith('_'):
+        if parts[1] == '_design' and len(parts) > 3:
+            return parts[3][1:], parts[0]
+        if parts[1] in _db_operations:
+            return _db_operations[parts[1]], parts[0]
+        if parts[1] == '_index':
+            return _index_operations.get(method, 'index'), parts[0]
+    # doc ids are escaped, the depth of the path is that of the resource
+    names = _method_operations[min(len(parts), 3) - 1]
+    return names.get(method, method.lower()), parts[0]
+
+
+class Instrument(object):
+    """Hooks for instrumenting the requests of one or more `AsyncCouch`
+    clients, given as `instrument`. The hooks do nothing, sub-classes
+    override them. The hooks are called in the IOLoop of the client, and
+    shall not block.
+    """
+
+    def before_request(self, info):
+        """Called with the `RequestInfo` of a request, before it is made,
+        when only the operation, database, method and request size are
+        known."""
+
+    def after_request(self, info):
+        """Called with the completed `RequestInfo`, when the response is
+        received, and decoded, or the request failed."""
+
+
+class Metrics(Instrument):
+    """Aggregated counters and latency histograms of the requests of one or
+    more `AsyncCouch` clients, for each operation.
+
+    The elapsed times are counted in histogram `buckets`, upper bounds in
+    seconds, for estimating percentiles. The metrics may be exported in
+    the Prometheus text format by `prometheus()`, or as StatsD gauges by
+    `statsd()`.
+    """
+
+    buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+               0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, buckets=None):
+        if buckets is not None:
+            self.buckets = tuple(sorted(buckets))
+        self._ops = {}
+
+    def after_request(self, info):
+        op = self._ops.get(info.operation)
+        if op is None:
+            op = self._ops[info.operation] = _OperationMetrics(
+                len(self.buckets))
+        op.requests += 1
+        if info.error is not None or info.status >= 400:
+            op.errors += 1
+        op.request_bytes += info.request_bytes
+        op.response_bytes += info.response_bytes
+        op.elapsed += info.elapsed
+        op.queue_time += info.queue_time
+        op.network_time += info.network_time
+        op.decode_time += info.decode_time
+        op.counts[bisect.bisect_left(self.buckets, info.elapsed)] += 1
+
+    def percentile(self, operation, q):
+        """Estimate the `q` percentile, from 0 to 100, of the elapsed time
+        of the `operation`, in seconds, by linear interpolation in the
+        histogram. Returns None if no requests are counted."""
+        op = self._ops.get(operation)
+        if op is None or not op.requests:
+            return None
+        rank = q / 100.0 * op.requests
+        seen = 0
+        for i, count in enumerate(op.counts):
+            if count and seen + count >= rank:
+                if i == len(self.buckets):
+                    # beyond the largest bucket
+                    return self.buckets[-1]
+                lower = self.buckets[i - 1] if i else 0.0
+                return lower + (self.buckets[i] - lower) * \
+                    (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+    def stats(self):
+        """Get the metrics as a dict by operation, with the number of
+        `requests` and `errors`, the `request_bytes` and `response_bytes`,
+        the estimated `p50` and `p99` elapsed time, and the mean elapsed,
+        `queue_time`, `network_time` and `decode_time`, in seconds.
+        """
+        stats = {}
+        for name, op in self._ops.items():
+            n = float(op.requests)
+            stats[name] = {
+                'requests': op.requests, 'errors': op.errors,
+                'request_bytes': op.request_bytes,
+                'response_bytes': op.response_bytes,
+                'p50': self.percentile(name, 50),
+                'p99': self.percentile(name, 99),
+                'elapsed': op.elapsed / n, 'queue_time': op.queue_time / n,
+                'network_time': op.network_time / n,
+                'decode_time': op.decode_time / n}
+        return stats
+
+    def reset(self):
+        """Reset the metrics of all operations."""
+        self._ops = {}
+
+    def prometheus(self, prefix='couch'):
+        """Get the metrics in the Prometheus text exposition format, with
+        the metric names prefixed by `prefix`."""
+        lines = []
+
+        def add(name, kind, help, samples):
+            lines.append('# HELP {0}_{1} {2}'.format(prefix, name, help))
+            lines.append('# TYPE {0}_{1} {2}'.format(prefix, name, kind))
+            for suffix, labels, value in samples:
+                lines.append('{0}_{1}{2}{{{3}}} {4}'.format(
+                    prefix, name, suffix, ','.join(
+                        '{0}="{1}"'.format(k, v) for k, v in labels),
+                    repr(float(value)) if isinstance(value, float)
+                    else value))
+
+        ops = sorted(self._ops.items())
+        samples = []
+        for name, op in ops:
+            total = 0
+            for bound, count in zip(self.buckets + ('+Inf',), op.counts):
+                total += count
+                samples.append(('_bucket', (('operation', name),
+                                            ('le', bound)), total))
+            samples.append(('_sum', (('operation', name),), op.elapsed))
+            samples.append(('_count', (('operation', name),), op.requests))
+        add('request_duration_seconds', 'histogram',
+            'Elapsed time of requests.', samples)
+        add('request_errors_total', 'counter', 'Failed requests.',
+            [('', (('operation', name),), op.errors) for name, op in ops])
+        add('request_bytes_total', 'counter', 'Bytes of request bodies.',
+            [('', (('operation', name),), op.request_bytes)
+             for name, op in ops])
+        add('response_bytes_total', 'counter', 'Bytes of response bodies.',
+            [('', (('operation', name),), op.response_bytes)
+             for name, op in ops])
+        add('request_phase_seconds_total', 'counter',
+            'Time of requests spent in each phase.',
+            [('', (('operation', name), ('phase', phase)),
+              getattr(op, phase + '_time'))
+             for name, op in ops
+             for phase in ('queue', 'network', 'decode')])
+        return '\n'.join(lines) + '\n'
+
+    def statsd(self, prefix='couch'):
+        """Get the metrics as a list of StatsD gauges, named
+        `prefix`.operation.metric, with times in milliseconds."""
+        lines = []
+        for name, stats in sorted(self.stats().items()):
+            for key, value in sorted(stats.items()):
+                if key.endswith('_time') or key in ('p50', 'p99', 'elapsed'):
+                    value = round(value * 1000, 3)
+                lines.append('{0}.{1}.{2}:{3}|g'.format(
+                    prefix, name, key, value))
+        return lines
+
+
+class _OperationMetrics(object):
+    # the counters and histogram of one operation, with a count for
+    # elapsed times above the largest bucket
+
+    __slots__ = ('requests', 'errors', 'request_bytes', 'response_bytes',
+                 'elapsed', 'queue_time', 'network_time', 'decode_time',
+                 'counts')
+
+    def __init__(self, buckets):
+        self.requests = self.errors = 0
+        self.request_bytes = self.response_bytes = 0
+        self.elapsed = self.queue_time = 0.0
+        self.network_time = self.decode_time = 0.0
+        self.counts = [0] * (buckets + 1)
+
+
+class DocCache(object):
+    """Size-bounded LRU cache of documents, for use with `AsyncCouch`.
+
+    At most `max_entries` documents, with a total size of at most
+    `max_bytes` JSON encoded, are kept in the cache. The least recently used
+    documents are evicted first. If `ttl` is None, a cached document is
+    always revalidated with the database (getting a 304 Not Modified
+    response if it is unchanged), otherwise it is used without revalidation
+    for `ttl` seconds after being fetched or revalidated.
+
+    The documents are cached JSON encoded, and decoded for every call, such
+    that callers may modify the returned documents.
+
+    The counters `hits` (used without revalidation), `revalidations` (used
+    after revalidation), `misses` (fetched from the database) and
+    `evictions` are available as attributes, or as a dict from `stats()`.
+    """
+
+    def __init__(self, max_entries=1000, max_bytes=None, ttl=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self.hits = 0
+        self.revalidations = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def lookup(self, key):
+        """Get the cached entry for the `key` as a tuple of ETag, JSON
+        body and whether the entry is fresh (not to be revalidated), or None
+        if there is no entry."""
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries[key] = entry
+        etag, body, timestamp = entry
+        fresh = self.ttl is not None and time.time() - timestamp < self.ttl
+        if fresh:
+            self.hits += 1
+        return etag, body, fresh
+
+    def put(self, key, etag, body):
+        """Cache the JSON `body` with the given `etag`."""
+        old = self._entries.pop(key, None)
+        if old is not None:
+            # the cached entry was outdated
+            self.misses += 1
+            self.size -= len(old[1])
+        if etag is None or (self.max_bytes is not None and
+                            len(body) > self.max_bytes):
+            return
+        self._entries[key] = (etag, body, time.time())
+        self.size += len(body)
+        while len(self._entries) > self.max_entries or (
+                self.max_bytes is not None and self.size > self.max_bytes):
+            _, entry = self._entries.popitem(last=False)
+            self.size -= len(entry[1])
+            self.evictions += 1
+
+    def touch(self, key):
+        """Mark the entry for `key` as revalidated."""
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries[key] = (entry[0], entry[1], time.time())
+            self.revalidations += 1
+
+    def invalidate(self, key):
+        """Remove the entry for `key`, if any."""
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[1])
+
+    def clear(self):
+        """Remove all entries."""
+        self._entries.clear()
+        self.size = 0
+
+    def stats(self):
+        """Get the counters, and the number and size of entries."""
+        return {'hits': self.hits, 'revalidations': self.revalidations,
+                'misses': self.misses, 'evictions': self.evictions,
+                'entries': len(self._entries), 'size': self.size}
+
+
+class RowStream(object):
+    """Asynchronous iterator over rows streamed from the database.
+
+    Rows are delivered as they are parsed from the response, which is never
+    held in memory as a whole. Rows received before they are consumed are
+    queued, at most `maxsize` rows if given, else without limit. Iterate by
+    yielding to `fetch_next`::
+
+        while (yield stream.fetch_next):
+            row = stream.next_object()
+
+    or, on Python 3.5 and later, using ``async for row in stream``.
+
+    If the database call results in an error, it is raised from
+    `fetch_next` after any rows received before the error.
+    """
+
+    def __init__(self, maxsize=0):
+        self.closed = False
+        self._queue = queues.Queue(maxsize)
+        self._room = locks.Condition()
+        self._full = False
+        self._row = None
+        self._ended = False
+        self._done = False
+        self._error = None
+
+    @property
+    def fetch_next(self):
+        """A Future resolving to True if a row is available from
+        `next_object()`, or to False when the stream is exhausted."""
+        return self._fetch_next()
+
+    def next_object(self):
+        """Get the row made available by `fetch_next`."""
+        row, self._row = self._row, None
+        return row
+
+    def close(self):
+        """Stop the stream, discarding any rows not yet fetched."""
+        if not self.closed:
+            self.closed = True
+            self._finish()
+            # free any producer waiting to put a row
+            while not self._queue.empty():
+                self._queue.get_nowait()
+            self._room.notify_all()
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        return self._anext()
+
+    @gen.coroutine
+    def _anext(self):
+        more = yield self._fetch_next()
+        if not more:
+            raise _StopAsyncIteration()
+        raise gen.Return(self.next_object())
+
+    @gen.coroutine
+    def _fetch_next(self):
+        if self.closed:
+            raise gen.Return(False)
+        if not self._done:
+            if self._ended and self._queue.empty():
+                self._done = True
+            else:
+                row = yield self._queue.get()
+                self._room.notify_all()
+                if row is not _END:
+                    self._row = row
+                    raise gen.Return(True)
+                self._done = True
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+        raise gen.Return(False)
+
+    def _put(self, row):
+        if self.closed:
+            raise _StreamClosed()
+        self._queue.put_nowait(row)
+
+    def _put_wait(self, row):
+        # put row, waiting for room in a bounded stream
+        if self.closed:
+            raise _StreamClosed()
+        return self._queue.put(row)
+
+    def _offer(self, row):
+        # put row, or if the bounded stream is full, abort the request
+        # streaming the rows, for resuming it after the last queued row
+        if self.closed:
+            raise _StreamClosed()
+        if self._queue.full():
+            self._full = True
+            raise _StreamClosed()
+        self._queue.put_nowait(row)
+
+    @gen.coroutine
+    def _wait_room(self):
+        # wait until at most half of a bounded stream is used
+        while not self.closed and \
+                self._queue.qsize() > self._queue.maxsize // 2:
+            yield self._room.wait()
+
+    def _finish(self, error=None):
+        if self._error is None:
+            self._error = error
+        if not self._ended:
+            self._ended = True
+            if self._queue.empty():
+                # wake up a consumer waiting for rows
+                self._queue.put_nowait(_END)
+
+
+class ViewStream(RowStream):
+    """Stream of rows from a view query.
+
+    When the stream is exhausted, the `total_rows` and `offset` (or
+    `update_seq`, if requested) of the view result are available as
+    attributes. If an error row is received, e.g. a missing key, the
+    corresponding CouchException is raised from `fetch_next`. At most
+    `maxsize` rows are queued, see `AsyncCouch.view_stream()`.
+    """
+
+    def __init__(self, maxsize=0):
+        RowStream.__init__(self, maxsize)
+        self.total_rows = None
+        self.offset = None
+        self.update_seq = None
+        self._resumable = True
+        self._rows = 0      # rows queued
+        self._last = None   # key and id of the last queued row
+        self._repeats = 0   # number of rows queued last with that key and id
+
+    def _put_row(self, row):
+        if self._ended:
+            # skip rows following an error
+            return
+        if 'error' in row:
+            self._finish(relax_exception(httpclient.HTTPError(
+                _error_code(row['error']), row['error'])))
+        elif self._resumable and 'id' in row:
+            self._offer(row)
+            last = (row['key'], row['id'])
+            self._repeats = self._repeats + 1 if last == self._last else 1
+            self._last = last
+            self._rows += 1
+        else:
+            self._put(row)
+            self._rows += 1
+
+    def _set_meta(self, meta, queued=0):
+        # the offset of a resumed query is the offset of its last request,
+        # less the rows queued before it
+        if meta:
+            self.total_rows = meta.get('total_rows')
+            self.offset = meta.get('offset')
+            if self.offset is not None:
+                self.offset -= queued
+            self.update_seq = meta.get('update_seq')
+
+
+class FindStream(RowStream):
+    """Stream of docs from a paged Mango query.
+
+    The `bookmark` of the latest page received, for resuming the query, and
+    any `warning` from the database are available as attributes. If
+    requested, the `execution_stats` of the pages received are summed.
+    """
+
+    def __init__(self, maxsize=0):
+        RowStream.__init__(self, maxsize)
+        self.bookmark = None
+        self.warning = None
+        self.execution_stats = None
+
+    def _add_page(self, r):
+        self.bookmark = r.get('bookmark')
+        self.warning = r.get('warning', self.warning)
+        stats = r.get('execution_stats')
+        if stats is not None:
+            if self.execution_stats is None:
+                self.execution_stats = dict(stats)
+            else:
+                for key, value in stats.items():
+                    if isinstance(value, numbers.Number):
+                        self.execution_stats[key] = \
+                            self.execution_stats.get(key, 0) + value
+
+
+class BlockingRowStream(object):
+    """Blocking iterator over the rows of a `RowStream`, used by
+    `BlockingCouch`. The wrapped stream is available as `stream`, e.g. for
+    getting the `last_seq` of a `ChangesFeed`."""
+
+    def __init__(self, stream, io_loop):
+        self.stream = stream
+        self.io_loop = io_loop
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if not self.io_loop.run_sync(lambda: self.stream.fetch_next):
+            raise StopIteration()
+        return self.stream.next_object()
+
+    next = __next__  # Python 2
+
+    def close(self):
+        """Stop the stream, discarding any rows not yet fetched."""
+        self.stream.close()
+
+
+class ThreadedRowStream(BlockingRowStream):
+    """Blocking iterator over the rows of a `RowStream`, used by
+    `ThreadedCouch`."""
+
+    def __init__(self, stream, loop):
+        BlockingRowStream.__init__(self, stream, loop.io_loop)
+        self._loop = loop
+
+    def __next__(self):
+        if not self._loop.submit(lambda: self.stream.fetch_next).result():
+            raise StopIteration()
+        return self._loop.submit(self.stream.next_object).result()
+
+    next = __next__  # Python 2
+
+    def close(self):
+        """Stop the stream, discarding any rows not yet fetched."""
+        self._loop.submit(self.stream.close).result()
+
+
+class ChangesFeed(RowStream):
+    """Stream of rows from the changes feed of a database.
+
+    The sequence of the latest change received is available as `last_seq`,
+    and the time of the latest data or heartbeat received from the database
+    as `last_activity`.
+
+    Closing the feed aborts its request when the next data or heartbeat is
+    received, releasing the connection. At most `maxsize` rows are queued,
+    see `AsyncCouch.changes()`.
+    """
+
+    def __init__(self, since=None, maxsize=0):
+        RowStream.__init__(self, maxsize)
+        self.last_seq = since
+        self.last_activity = None
+
+    def _put_change(self, row):
+        self.last_activity = time.time()
+        if 'seq' in row:
+            self._offer(row)
+            self.last_seq = row['seq']
+        elif 'last_seq' in row:
+            # end of a continuous feed
+            self.last_seq = row['last_seq']
+
+
+class _StreamClosed(httputil.HTTPInputError):
+    """Raised to abort a streaming request when its stream is closed, or
+    full. It is
+    an HTTPInputError, for Tornado to close the connection without logging
+    the exception as uncaught."""
+
+
+_END = object()
+
+
+class _LineParser(object):
+    """Incremental parser for newline delimited JSON, as used by the
+    continuous and eventsource changes feeds. Empty (heartbeat) lines and
+    eventsource fields other than `data` are skipped."""
+
+    def __init__(self, callback, decode=_json_loads):
+        self.callback = callback
+        self.decode = decode
+        self._buf = b''
+
+    def feed(self, chunk):
+        lines = (self._buf + chunk).split(b'\n')
+        self._buf = lines.pop()
+        for line in lines:
+            self._parse(line)
+
+    def close(self):
+        buf, self._buf = self._buf, b''
+        self._parse(buf)
+
+    def _parse(self, line):
+        line = line.strip()
+        if line.startswith(b'data:'):
+            line = line[5:].lstrip()
+        if line.startswith(b'{'):
+            self.callback(self.decode(line))
+
+
+class _RowParser(object):
+    """Incremental parser for JSON objects with a list of rows, e.g. view
+    results, where each row in the list named by `key` (a JSON string given
+    as bytes, e.g. ``b'"rows"'``) is decoded and passed to the callback as
+    soon as it has been received. The remaining object, with an empty list
+    of rows, is returned by `close()`."""
+
+    _token = re.compile(br'"(?:[^"\\]|\\.)*"|"|[\[\]{}]')
+
+    def __init__(self, key, callback, decode=_json_loads):
+        self.key = key
+        self.callback = callback
+        self.decode = decode
+        self._buf = b''
+        self._pos = 0       # position in buffer to continue scanning from
+        self._mark = 0      # position in buffer of data not part of the rows
+        self._depth = 0
+        self._name = None   # last string seen in the outermost object
+        self._in_rows = False
+        self._start = None  # position in buffer of the current row
+        self._head = []     # received data not part of the rows
+
+    def feed(self, chunk):
+        buf = self._buf + chunk
+        pos, mark, depth = self._pos, self._mark, self._depth
+        for m in self._token.finditer(buf, pos):
+            token = m.group()
+            if token == b'"':
+                # string continues in the next chunk
+                break
+            pos = m.end()
+            c = token[:1]
+            if c == b'"':
+                if depth == 1:
+                    self._name = token
+            elif c in b'[{':
+                depth += 1
+                if self._in_rows:
+                    if depth == 3:
+                        self._start = m.start()
+                elif depth == 2 and c == b'[' and self._name == self.key:
+                    self._in_rows = True
+                    self._head.append(buf[mark:pos])
+            else:
+                depth -= 1
+                if self._in_rows:
+                    if depth == 2 and self._start is not None:
+                        self.callback(self.decode(buf[self._start:pos]))
+                        self._start = None
+                    elif depth == 1:
+                        self._in_rows = False
+                        mark = m.start()
+        else:
+            pos = len(buf)
+        # drop data that has been parsed, and is not part of the head
+        if not self._in_rows:
+            cut = mark
+        elif self._start is None:
+            cut = pos
+        else:
+            cut = self._start
+            self._start = 0
+        self._buf = buf[cut:]
+        self._pos, self._mark, self._depth = pos - cut, mark - cut, depth
+
+    def close(self):
+        """Returns the decoded object without rows, or None if empty."""
+        data = b''.join(self._head) + self._buf[self._mark:]
+        self._head, self._buf = [], b''
+        return self.decode(data) if data.strip() else None
+
+
+class _MultipartParser(object):
+    """Incremental parser for a multipart/related response with a document
+    and its attachments. The data of each attachment is passed to the
+    function returned by `dest` as it is received, or else set in the info
+    of the attachment. The doc is returned by `close()`. A JSON response,
+    for a doc without attachments, is also accepted."""
+
+    _filename = re.compile(br'filename="((?:[^"\\]|\\.)*)"')
+
+    def __init__(self, dest, decode=_json_loads):
+        self.dest = dest
+        self.decode = decode
+        self.doc = None
+        self._buf = b''
+        self._state = 'start'
+        self._delimiter = None
+        self._data = []     # data of the doc, or of the current attachment
+        self._names = []    # names of the attachments following the doc
+        self._info = None   # info of the current attachment
+        self._write = None
+
+    def feed(self, chunk):
+        buf = self._buf + chunk
+        while True:
+            if self._state == 'start':
+                if buf[:1] == b'{':
+                    self._state = 'json'
+                    continue
+                i = buf.find(b'\r\n')
+                if i < 0:
+                    break
+                # the body starts with the delimiter line
+                self._delimiter = b'\r\n' + buf[:i]
+                buf = buf[i + 2:]
+                self._state = 'headers'
+            elif self._state == 'headers':
+                if buf.startswith(b'\r\n'):
+                    headers, buf = b'', buf[2:]
+                else:
+                    i = buf.find(b'\r\n\r\n')
+                    if i < 0:
+                        break
+                    headers, buf = buf[:i], buf[i + 4:]
+                self._start_part(headers)
+                self._state = 'body'
+            elif self._state == 'body':
+                i = buf.find(self._delimiter)
+                if i < 0:
+                    # keep data, that may be the start of the delimiter
+                    keep = len(self._delimiter) - 1
+                    if len(buf) > keep:
+                        self._put(buf[:len(buf) - keep])
+                        buf = buf[len(buf) - keep:]
+                    break
+                self._put(buf[:i])
+                self._end_part()
+                buf = buf[i + len(self._delimiter):]
+                self._state = 'delimiter'
+            elif self._state == 'delimiter':
+                if len(buf) < 2:
+                    break
+                # the last delimiter is followed by '--'
+                self._state = 'end' if buf[:2] == b'--' else 'headers'
+                buf = buf[2:]
+            elif self._state == 'json':
+                self._data.append(buf)
+                buf = b''
+                break
+            else:
+                buf = b''
+                break
+        self._buf = buf
+
+    def close(self):
+        """Returns the decoded doc."""
+        if self._state == 'json':
+            self.doc = self.decode(b''.join(self._data))
+        self._data = []
+        return self.doc
+
+    def _start_part(self, headers):
+        if self.doc is None:
+            return
+        m = self._filename.search(headers)
+        if m:
+            name = m.group(1).decode('utf8')
+        else:
+            name = self._names[0]
+        if name in self._names:
+            self._names.remove(name)
+        self._info = self.doc['_attachments'][name]
+        self._info.pop('follows', None)
+        if self.dest is not None:
+            self._write = self.dest(name, self._info)
+
+    def _put(self, data):
+        if self._write is not None:
+            self._write(data)
+        else:
+            self._data.append(data)
+
+    def _end_part(self):
+        if self.doc is None:
+            # the first part is the doc
+            self.doc = self.decode(b''.join(self._data))
+            self._names = [name for name, info in
+                           (self.doc.get('_attachments') or {}).items()
+                           if info.get('follows')]
+        elif self._write is None:
+            self._info['data'] = b''.join(self._data)
+        self._data = []
+        self._write = None
+
+
 class CouchException(httpclient.HTTPError):
     """Base class for Couch specific exceptions"""
 
@@ -679,6 +3514,16 @@ class InternalServerError(CouchException):
             'prevented it from processing the request.')
 
 
+class CircuitOpen(CouchException):
+    """Raised without making a request, while the circuit breaker of the
+    retry policy is open"""
+
+    def __init__(self, HTTPError):
+        CouchException.__init__(
+            self, HTTPError, 'The request was not made, as requests to the '
+            'database are failing.')
+
+
 def relax_exception(e):
     """Convert HTTPError exception to a Couch specific exception, if possible,
     or else return the unmodified exception."""
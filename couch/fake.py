@@ -0,0 +1,819 @@
+"""In-process stand-in for a CouchDB server, using Tornado's web server, for
+benchmarking the clients without a database.
+
+The server keeps its databases in memory, and serves the endpoints used by
+the clients: databases, documents, the bulk docs API, the _all_docs view,
+views, attachments, the changes feed, Mango queries and indexes, and
+replication between its own databases. A view of any existing design
+document emits the id of each document, that is not a design document, as
+key, with value null. Multipart requests, reduce and filters are not
+supported. Each request may be delayed by a fixed `latency`.
+
+Example usage::
+
+    from couch.fake import FakeCouch
+
+    with FakeCouch(latency=0.001) as server:
+        db = couch.BlockingCouch('mydb', server.url)
+        db.create_db()
+"""
+
+import collections
+import datetime
+import hashlib
+import re
+import threading
+import time
+
+import tornado.ioloop
+from tornado import gen, httpserver, locks, netutil, web
+from tornado.escape import json_decode, url_unescape, utf8
+
+from .couch import json_encode
+
+try:
+    import asyncio
+except ImportError:
+    # Python 2, with Tornado 4
+    asyncio = None
+
+
+__all__ = ["FakeCouch"]
+
+
+class FakeCouch(object):
+    """In-memory CouchDB stand-in, serving on a local port.
+
+    The server is started in a background thread by `start()`, or on
+    entering the context, and serves at `url`, until `stop()`. Each request
+    is delayed by `latency` seconds, if given, without blocking the server.
+    The revisions and the generated ids and uuids depend only on the order
+    of the requests, for reproducible runs.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.url = None
+        self.dbs = {}
+        self.requests = 0
+        self._uuid = 0
+        self._io_loop = None
+        self._thread = None
+
+    def start(self):
+        """Start serving in a background thread, returns the url."""
+        started = threading.Event()
+
+        def run():
+            if tornado.version_info < (5,):
+                self._io_loop = tornado.ioloop.IOLoop()
+                self._io_loop.make_current()
+            else:
+                # from Tornado 5 on, the IOLoop of the thread wraps its
+                # asyncio event loop
+                asyncio.set_event_loop(asyncio.new_event_loop())
+                self._io_loop = tornado.ioloop.IOLoop.current()
+            sockets = netutil.bind_sockets(0, '127.0.0.1')
+            server = httpserver.HTTPServer(self._application())
+            server.add_sockets(sockets)
+            self.url = 'http://127.0.0.1:{0}/'.format(
+                sockets[0].getsockname()[1])
+            self._io_loop.add_callback(started.set)
+            self._io_loop.start()
+            server.stop()
+            self._io_loop.close(all_fds=True)
+
+        self._thread = threading.Thread(target=run, name='fake-couch')
+        self._thread.daemon = True
+        self._thread.start()
+        started.wait()
+        return self.url
+
+    def stop(self):
+        """Stop the server, and wait for the thread to finish."""
+        if self._thread is not None:
+            self._io_loop.add_callback(self._io_loop.stop)
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def uuid(self):
+        """Get the next generated uuid."""
+        self._uuid += 1
+        return '{0:032x}'.format(self._uuid)
+
+    def _application(self):
+        args = {'server': self}
+        return web.Application([
+            (r'/_all_dbs', _AllDbsHandler, args),
+            (r'/_uuids', _UuidsHandler, args),
+            (r'/_up', _UpHandler, args),
+            (r'/_replicate', _ReplicateHandler, args),
+            (r'/([^/_][^/]*)/?', _DatabaseHandler, args),
+            (r'/([^/]+)/_bulk_docs', _BulkDocsHandler, args),
+            (r'/([^/]+)/_all_docs', _AllDocsHandler, args),
+            (r'/([^/]+)/_design/([^/]+)/_view/([^/]+)', _ViewHandler, args),
+            (r'/([^/]+)/_changes', _ChangesHandler, args),
+            (r'/([^/]+)/_find', _FindHandler, args),
+            (r'/([^/]+)/_explain', _ExplainHandler, args),
+            (r'/([^/]+)/_index/?', _IndexHandler, args),
+            (r'/([^/]+)/_index/([^/]+)/([^/]+)/([^/]+)', _IndexHandler, args),
+            (r'/([^/]+)/([^/]+)', _DocHandler, args),
+            (r'/([^/]+)/([^/]+)/([^/]+)', _AttachmentHandler, args),
+        ], log_function=lambda handler: None, compress_response=False)
+
+
+class _Database(object):
+    # the documents of a database, with the tombstones of deleted docs and
+    # the latest change of each document
+
+    def __init__(self, name):
+        self.name = name
+        self.docs = {}
+        self.deleted = {}
+        self.attachments = {}
+        self.changes = collections.OrderedDict()
+        self.seq = 0
+        self.changed = locks.Condition()
+        self.indexes = collections.OrderedDict()
+        self._sorted = None
+
+    def info(self):
+        return {'db_name': self.name, 'doc_count': len(self.docs),
+                'doc_del_count': len(self.deleted), 'update_seq': self.seq}
+
+    def sorted_ids(self):
+        if self._sorted is None:
+            self._sorted = sorted(self.docs)
+        return self._sorted
+
+    def save(self, doc, new_edits=True):
+        # save or delete a doc, returning the new revision, or raising
+        # Conflict on a revision that is not the current one
+        doc_id = doc['_id']
+        current = self.docs.get(doc_id)
+        if new_edits:
+            rev = doc.get('_rev')
+            current_rev = current['_rev'] if current else \
+                self.deleted.get(doc_id)
+            if current is not None and rev != current_rev:
+                raise _Error(409, 'conflict', 'Document update conflict.')
+            if current is None and rev is not None and rev != current_rev:
+                raise _Error(409, 'conflict', 'Document update conflict.')
+            doc = dict(doc, _rev=_new_rev(current_rev, doc))
+            if current is not None and '_attachments' in current:
+                # attachments are kept, unless given
+                doc.setdefault('_attachments', current['_attachments'])
+        self._sorted = None
+        if doc.get('_deleted'):
+            self.docs.pop(doc_id, None)
+            self.deleted[doc_id] = doc['_rev']
+            for key in [key for key in self.attachments if key[0] == doc_id]:
+                del self.attachments[key]
+        else:
+            self.docs[doc_id] = doc
+            self.deleted.pop(doc_id, None)
+        self.seq += 1
+        self.changes.pop(doc_id, None)
+        self.changes[doc_id] = self.seq
+        self.changed.notify_all()
+        return doc['_rev']
+
+    def change(self, doc_id, seq, include_docs):
+        doc = self.docs.get(doc_id)
+        rev = doc['_rev'] if doc else self.deleted[doc_id]
+        row = {'seq': seq, 'id': doc_id, 'changes': [{'rev': rev}]}
+        if doc is None:
+            row['deleted'] = True
+        if include_docs:
+            row['doc'] = doc or {'_id': doc_id, '_rev': rev, '_deleted': True}
+        return row
+
+
+class _Error(web.HTTPError):
+    # an error response, with a CouchDB error and reason
+
+    def __init__(self, status, error, reason):
+        web.HTTPError.__init__(self, status, reason)
+        self.error = error
+        self.reason = reason
+
+
+def _new_rev(rev, doc):
+    # the next revision, with a digest of the doc
+    n = int(rev.split('-', 1)[0]) + 1 if rev else 1
+    return '{0}-{1}'.format(n, hashlib.md5(utf8(json_encode(
+        dict((k, v) for k, v in doc.items() if k != '_rev')))).hexdigest())
+
+
+_ALL_DOCS_INDEX = {'ddoc': None, 'name': '_all_docs', 'type': 'special',
+                   'def': {'fields': [{'_id': 'asc'}]}}
+
+_MISSING = object()
+
+
+def _field(doc, path):
+    # the value of the dotted field path in the doc, or _MISSING
+    for name in path.split('.'):
+        if not isinstance(doc, dict) or name not in doc:
+            return _MISSING
+        doc = doc[name]
+    return doc
+
+
+def _sort_fields(sort):
+    return [next(iter(f.items())) if isinstance(f, dict) else (f, 'asc')
+            for f in sort]
+
+
+def _plan(db, query):
+    # select the index of a Mango query, the first json index of a field in
+    # the selector, or in the sort, returning the index and the docs it
+    # examines, or None and all docs
+    selector = query.get('selector', {})
+    sort = [field for field, _ in _sort_fields(query.get('sort', []))]
+    use_index = query.get('use_index')
+    if isinstance(use_index, list):
+        use_index = tuple(use_index)
+    for (ddoc, name), index in db.indexes.items():
+        first = next(iter(index['def']['fields'][0]))
+        if use_index is not None and \
+                use_index not in (ddoc[8:], ddoc, (ddoc[8:], name),
+                                  (ddoc, name)):
+            continue
+        if first in selector or (sort and first == sort[0]):
+            docs = [doc for doc_id, doc in sorted(db.docs.items())
+                    if _field(doc, first) is not _MISSING]
+            return index, docs
+    if sort:
+        raise _Error(400, 'no_usable_index',
+                     'No index exists for this sort, try indexing by the '
+                     'sort fields.')
+    return None, [db.docs[doc_id] for doc_id in db.sorted_ids()]
+
+
+def _compare(op):
+    def test(value, arg):
+        try:
+            return value is not _MISSING and op(value, arg)
+        except TypeError:
+            return False
+    return test
+
+
+_OPERATORS = {
+    '$eq': _compare(lambda a, b: a == b),
+    '$ne': lambda value, arg: value != arg,
+    '$gt': _compare(lambda a, b: a > b),
+    '$gte': _compare(lambda a, b: a >= b),
+    '$lt': _compare(lambda a, b: a < b),
+    '$lte': _compare(lambda a, b: a <= b),
+    '$in': _compare(lambda a, b: a in b),
+    '$nin': lambda value, arg: value not in arg,
+    '$exists': lambda value, arg: (value is not _MISSING) == arg,
+    '$size': _compare(lambda a, b: isinstance(a, list) and len(a) == b),
+    '$all': _compare(lambda a, b: isinstance(a, list) and
+                     all(x in a for x in b)),
+    '$elemMatch': _compare(lambda a, b: isinstance(a, list) and
+                           any(_test(x, b) for x in a)),
+    '$regex': _compare(lambda a, b: re.search(b, a) is not None),
+}
+
+
+def _match(doc, selector):
+    # whether the doc matches the Mango selector
+    for key, cond in selector.items():
+        if key == '$and':
+            ok = all(_match(doc, s) for s in cond)
+        elif key == '$or':
+            ok = any(_match(doc, s) for s in cond)
+        elif key == '$nor':
+            ok = not any(_match(doc, s) for s in cond)
+        elif key == '$not':
+            ok = not _match(doc, cond)
+        else:
+            ok = _test(_field(doc, key), cond)
+        if not ok:
+            return False
+    return True
+
+
+def _test(value, cond):
+    # whether the value matches the condition of a field
+    if not isinstance(cond, dict):
+        return _OPERATORS['$eq'](value, cond)
+    if not all(key.startswith('$') for key in cond):
+        # a nested selector
+        return isinstance(value, dict) and _match(value, cond)
+    for op, arg in cond.items():
+        if op == '$not':
+            ok = not _test(value, arg)
+        elif op in _OPERATORS:
+            ok = _OPERATORS[op](value, arg)
+        else:
+            raise _Error(400, 'invalid_operator',
+                         'Invalid operator: {0}'.format(op))
+        if not ok:
+            return False
+    return True
+
+
+class _Handler(web.RequestHandler):
+
+    # the positions of the path segments passed to the methods
+    segments = (0, 1, 2)
+
+    def initialize(self, server):
+        self.server = server
+
+    @gen.coroutine
+    def prepare(self):
+        self.server.requests += 1
+        # like CouchDB, "+" in the path is a space
+        segments = self.request.path.split('/')[1:]
+        self.path_args = [url_unescape(segments[i], plus=True)
+                          for i in self.segments[:len(self.path_args)]]
+        if 'multipart/' in self.request.headers.get('Content-Type', '') or \
+                'multipart/' in self.request.headers.get('Accept', ''):
+            raise _Error(400, 'bad_request', 'Multipart is not supported.')
+        if self.server.latency:
+            yield gen.sleep(self.server.latency)
+
+    def log_exception(self, typ, value, tb):
+        # error responses are expected, and are not logged
+        if not isinstance(value, _Error):
+            web.RequestHandler.log_exception(self, typ, value, tb)
+
+    def send(self, obj, status=200):
+        self.set_status(status)
+        self.set_header('Content-Type', 'application/json')
+        self.finish(json_encode(obj))
+
+    def write_error(self, status_code, **kwargs):
+        error = kwargs.get('exc_info', (None, None))[1]
+        if isinstance(error, _Error):
+            obj = {'error': error.error, 'reason': error.reason}
+        else:
+            obj = {'error': 'unknown_error', 'reason': self._reason}
+        self.set_header('Content-Type', 'application/json')
+        self.finish(json_encode(obj))
+
+    def body_json(self):
+        try:
+            return json_decode(self.request.body)
+        except ValueError:
+            raise _Error(400, 'bad_request', 'Invalid JSON.')
+
+    def query_json(self, name, default=None):
+        value = self.get_query_argument(name, None)
+        if value is None:
+            return default
+        try:
+            return json_decode(value)
+        except ValueError:
+            raise _Error(400, 'bad_request', 'Invalid value of ' + name)
+
+    def get_db(self, db_name):
+        db = self.server.dbs.get(db_name)
+        if db is None:
+            raise _Error(404, 'not_found', 'Database does not exist.')
+        return db
+
+    def get_doc(self, db, doc_id):
+        doc = db.docs.get(doc_id)
+        if doc is None:
+            raise _Error(404, 'not_found',
+                         'deleted' if doc_id in db.deleted else 'missing')
+        return doc
+
+    def query_rows(self, db, rows, keys):
+        # select the rows sorted by key and id, by the query parameters,
+        # setting the offset of the first row selected
+        descending = self.query_json('descending', False)
+        startkey = self.query_json('startkey', self.query_json('start_key'))
+        startkey_docid = self.get_query_argument('startkey_docid', None)
+        endkey = self.query_json('endkey', self.query_json('end_key'))
+        inclusive_end = self.query_json('inclusive_end', True)
+        include_docs = self.query_json('include_docs', False)
+        skip = self.query_json('skip', 0)
+        limit = self.query_json('limit')
+        if keys is not None:
+            by_key = collections.defaultdict(list)
+            for row in rows:
+                by_key[row['key']].append(row)
+            rows = [row for key in keys for row in by_key.get(key, ())]
+        elif descending:
+            rows = reversed(rows)
+        selected = []
+        self.offset = 0
+        for row in rows:
+            if keys is None:
+                start = (startkey, startkey_docid or '')
+                end = row['key'] if endkey is None else endkey
+                if descending:
+                    if startkey is not None and (
+                            (row['key'], row['id']) > start
+                            if startkey_docid else row['key'] > startkey):
+                        self.offset += 1
+                        continue
+                    if row['key'] < end or (row['key'] == end and
+                                            not inclusive_end):
+                        break
+                else:
+                    if startkey is not None and (row['key'], row['id']) < \
+                            start:
+                        self.offset += 1
+                        continue
+                    if row['key'] > end or (row['key'] == end and
+                                            not inclusive_end):
+                        break
+            if skip:
+                skip -= 1
+                self.offset += 1
+                continue
+            if limit is not None and len(selected) >= limit:
+                break
+            if include_docs:
+                row = dict(row, doc=db.docs.get(row['id']))
+            selected.append(row)
+        return selected
+
+
+class _AllDbsHandler(_Handler):
+
+    def get(self):
+        self.send(sorted(self.server.dbs))
+
+
+class _UuidsHandler(_Handler):
+
+    def get(self):
+        count = int(self.get_query_argument('count', 1))
+        self.send({'uuids': [self.server.uuid() for _ in range(count)]})
+
+
+class _UpHandler(_Handler):
+
+    def get(self):
+        self.send({'status': 'ok'})
+
+
+class _ReplicateHandler(_Handler):
+
+    def post(self):
+        body = self.body_json()
+        # databases are given by name or url
+        source = self.get_db(body['source'].rstrip('/').rsplit('/', 1)[-1])
+        target_name = body['target'].rstrip('/').rsplit('/', 1)[-1]
+        if target_name not in self.server.dbs:
+            if not body.get('create_target'):
+                raise _Error(404, 'not_found', 'Database does not exist.')
+            self.server.dbs[target_name] = _Database(target_name)
+        target = self.server.dbs[target_name]
+        for doc_id in list(source.changes):
+            doc = source.docs.get(doc_id) or {
+                '_id': doc_id, '_rev': source.deleted[doc_id],
+                '_deleted': True}
+            target.save(doc, new_edits=False)
+        for key, value in source.attachments.items():
+            target.attachments[key] = value
+        self.send({'ok': True, 'source_last_seq': source.seq})
+
+
+class _DatabaseHandler(_Handler):
+
+    def get(self, db_name):
+        self.send(self.get_db(db_name).info())
+
+    def head(self, db_name):
+        self.get_db(db_name)
+
+    def put(self, db_name):
+        if db_name in self.server.dbs:
+            raise _Error(412, 'file_exists', 'The database already exists.')
+        self.server.dbs[db_name] = _Database(db_name)
+        self.send({'ok': True}, 201)
+
+    def delete(self, db_name):
+        self.get_db(db_name)
+        del self.server.dbs[db_name]
+        self.send({'ok': True})
+
+    def post(self, db_name):
+        db = self.get_db(db_name)
+        doc = self.body_json()
+        doc.setdefault('_id', self.server.uuid())
+        rev = db.save(doc)
+        self.send({'ok': True, 'id': doc['_id'], 'rev': rev}, 201)
+
+
+class _BulkDocsHandler(_Handler):
+
+    def post(self, db_name):
+        db = self.get_db(db_name)
+        body = self.body_json()
+        new_edits = body.get('new_edits', True)
+        results = []
+        for doc in body['docs']:
+            doc.setdefault('_id', self.server.uuid())
+            try:
+                rev = db.save(doc, new_edits)
+                results.append({'ok': True, 'id': doc['_id'], 'rev': rev})
+            except _Error as e:
+                results.append({'id': doc['_id'], 'error': e.error,
+                                'reason': e.reason})
+        self.send(results, 201)
+
+
+class _AllDocsHandler(_Handler):
+
+    def get(self, db_name, keys=None):
+        db = self.get_db(db_name)
+        if keys is None:
+            rows = [{'id': doc_id, 'key': doc_id,
+                     'value': {'rev': db.docs[doc_id]['_rev']}}
+                    for doc_id in db.sorted_ids()]
+        else:
+            rows = []
+            for key in keys:
+                if key in db.docs:
+                    rows.append({'id': key, 'key': key,
+                                 'value': {'rev': db.docs[key]['_rev']}})
+                elif key in db.deleted:
+                    rows.append({'id': key, 'key': key, 'doc': None,
+                                 'value': {'rev': db.deleted[key],
+                                           'deleted': True}})
+                else:
+                    rows.append({'key': key, 'error': 'not_found'})
+        if keys is not None:
+            # the rows of the keys are given in order, without the other
+            # query parameters
+            if self.query_json('include_docs', False):
+                rows = [dict(row, doc=db.docs.get(row['id']))
+                        if 'value' in row and 'deleted' not in row['value']
+                        else row for row in rows]
+        else:
+            rows = self.query_rows(db, rows, None)
+        self.send({'total_rows': len(db.docs),
+                   'offset': 0 if keys is not None else self.offset,
+                   'rows': rows})
+
+    def post(self, db_name):
+        self.get(db_name, self.body_json().get('keys'))
+
+
+class _ViewHandler(_Handler):
+
+    segments = (0, 2, 4)
+
+    def get(self, db_name, ddoc, view, keys=None):
+        db = self.get_db(db_name)
+        self.get_doc(db, '_design/' + ddoc)
+        rows = [{'id': doc_id, 'key': doc_id, 'value': None}
+                for doc_id in db.sorted_ids()
+                if not doc_id.startswith('_design/')]
+        total_rows = len(rows)
+        rows = self.query_rows(db, rows, keys)
+        self.send({'total_rows': total_rows,
+                   'offset': 0 if keys is not None else self.offset,
+                   'rows': rows})
+
+    def post(self, db_name, ddoc, view):
+        self.get(db_name, ddoc, view, self.body_json().get('keys'))
+
+
+class _ChangesHandler(_Handler):
+
+    @gen.coroutine
+    def get(self, db_name):
+        db = self.get_db(db_name)
+        feed = self.get_query_argument('feed', 'normal')
+        since = self.get_query_argument('since', '0')
+        since = db.seq if since == 'now' else int(since or 0)
+        include_docs = self.query_json('include_docs', False)
+        limit = self.query_json('limit')
+        heartbeat = self.query_json('heartbeat')
+        timeout = self.query_json('timeout', 60000) / 1000.0
+        deadline = self.server._io_loop.time() + timeout
+
+        def pending():
+            return [doc_id for doc_id, seq in db.changes.items()
+                    if seq > since]
+
+        def changes(doc_ids):
+            if limit is not None:
+                doc_ids = doc_ids[:limit]
+            return [db.change(doc_id, db.changes[doc_id], include_docs)
+                    for doc_id in doc_ids]
+
+        doc_ids = pending()
+        if feed == 'longpoll' and not doc_ids:
+            yield db.changed.wait(datetime.timedelta(seconds=timeout))
+            doc_ids = pending()
+        rows = changes(doc_ids)
+        if feed in ('normal', 'longpoll'):
+            last_seq = rows[-1]['seq'] if rows else max(since, db.seq)
+            self.send({'results': rows, 'last_seq': last_seq,
+                       'pending': len(doc_ids) - len(rows)})
+            return
+        # continuous feed, until the client disconnects or the timeout
+        self.set_header('Content-Type', 'application/json')
+        self._disconnected = False
+        while not self._disconnected:
+            for row in rows:
+                self.write(json_encode(row) + '\n')
+                since = row['seq']
+                if limit is not None:
+                    limit -= 1
+            if rows:
+                yield self.flush()
+            remaining = deadline - self.server._io_loop.time()
+            if limit == 0 or remaining <= 0:
+                break
+            wait = min(remaining, heartbeat / 1000.0) if heartbeat else \
+                remaining
+            if not (yield db.changed.wait(datetime.timedelta(seconds=wait))) \
+                    and heartbeat and not self._disconnected:
+                self.write('\n')
+                yield self.flush()
+            rows = changes(pending())
+        if not self._disconnected:
+            self.finish(json_encode({'last_seq': since}) + '\n')
+
+    def on_connection_close(self):
+        self._disconnected = True
+        db = self.server.dbs.get(self.path_args[0])
+        if db is not None:
+            db.changed.notify_all()
+
+
+class _FindHandler(_Handler):
+
+    def post(self, db_name):
+        db = self.get_db(db_name)
+        query = self.body_json()
+        start = time.time()
+        index, candidates = _plan(db, query)
+        docs = [doc for doc in candidates
+                if _match(doc, query.get('selector', {}))]
+        if query.get('sort'):
+            for field, direction in reversed(_sort_fields(query['sort'])):
+                docs.sort(key=lambda doc: _field(doc, field),
+                          reverse=direction == 'desc')
+        offset = int(query['bookmark'][5:]) if query.get('bookmark') else \
+            query.get('skip', 0)
+        limit = query.get('limit', 25)
+        docs = docs[offset:offset + limit]
+        fields = query.get('fields')
+        if fields:
+            docs = [dict((f, doc[f]) for f in fields if f in doc)
+                    for doc in docs]
+        r = {'docs': docs, 'bookmark': 'fake-{0}'.format(offset + len(docs))}
+        if index is None:
+            r['warning'] = ('No matching index found, create an index to '
+                            'optimize query time.')
+        if query.get('execution_stats'):
+            r['execution_stats'] = {
+                'total_keys_examined': 0,
+                'total_docs_examined': len(candidates),
+                'total_quorum_docs_examined': 0,
+                'results_returned': len(docs),
+                'execution_time_ms': (time.time() - start) * 1000}
+        self.send(r)
+
+
+class _ExplainHandler(_Handler):
+
+    def post(self, db_name):
+        db = self.get_db(db_name)
+        query = self.body_json()
+        index, _ = _plan(db, query)
+        self.send({'dbname': db_name, 'index': index or _ALL_DOCS_INDEX,
+                   'selector': query.get('selector', {}),
+                   'fields': query.get('fields', 'all_fields'),
+                   'limit': query.get('limit', 25),
+                   'skip': query.get('skip', 0)})
+
+
+class _IndexHandler(_Handler):
+
+    segments = (0, 2, 3, 4)
+
+    def get(self, db_name):
+        db = self.get_db(db_name)
+        indexes = [_ALL_DOCS_INDEX] + list(db.indexes.values())
+        self.send({'total_rows': len(indexes), 'indexes': indexes})
+
+    def post(self, db_name):
+        db = self.get_db(db_name)
+        body = self.body_json()
+        fields = [{f: 'asc'} if not isinstance(f, dict) else f
+                  for f in body['index']['fields']]
+        name = body.get('name') or hashlib.md5(
+            utf8(json_encode(fields))).hexdigest()
+        ddoc = '_design/' + (body.get('ddoc') or name)
+        if (ddoc, name) in db.indexes:
+            self.send({'result': 'exists', 'id': ddoc, 'name': name})
+            return
+        db.indexes[(ddoc, name)] = {
+            'ddoc': ddoc, 'name': name, 'type': body.get('type', 'json'),
+            'def': dict(body['index'], fields=fields)}
+        self.send({'result': 'created', 'id': ddoc, 'name': name})
+
+    def delete(self, db_name, ddoc, type, name):
+        db = self.get_db(db_name)
+        if db.indexes.pop(('_design/' + ddoc, name), None) is None:
+            raise _Error(404, 'not_found', 'Index not found')
+        self.send({'ok': True})
+
+
+class _DocHandler(_Handler):
+
+    def get(self, db_name, doc_id):
+        doc = self.get_doc(self.get_db(db_name), doc_id)
+        etag = '"{0}"'.format(doc['_rev'])
+        if self.request.headers.get('If-None-Match') == etag:
+            self.set_status(304)
+            self.finish()
+            return
+        self.set_header('ETag', etag)
+        self.send(doc)
+
+    def head(self, db_name, doc_id):
+        doc = self.get_doc(self.get_db(db_name), doc_id)
+        self.set_header('ETag', '"{0}"'.format(doc['_rev']))
+
+    def put(self, db_name, doc_id):
+        db = self.get_db(db_name)
+        doc = dict(self.body_json(), _id=doc_id)
+        rev = db.save(doc)
+        self.set_header('ETag', '"{0}"'.format(rev))
+        self.send({'ok': True, 'id': doc_id, 'rev': rev}, 201)
+
+    def delete(self, db_name, doc_id):
+        db = self.get_db(db_name)
+        self.get_doc(db, doc_id)
+        rev = db.save({'_id': doc_id, '_deleted': True,
+                       '_rev': self.get_query_argument('rev', None)})
+        self.send({'ok': True, 'id': doc_id, 'rev': rev})
+
+
+class _AttachmentHandler(_Handler):
+
+    def get(self, db_name, doc_id, name):
+        db = self.get_db(db_name)
+        self.get_doc(db, doc_id)
+        if (doc_id, name) not in db.attachments:
+            raise _Error(404, 'not_found', 'Document is missing attachment')
+        content_type, data = db.attachments[(doc_id, name)]
+        self.set_header('Content-Type', content_type)
+        self.set_header('Accept-Ranges', 'bytes')
+        ranges = self.request.headers.get('Range', '')
+        if ranges.startswith('bytes='):
+            first, _, last = ranges[6:].partition('-')
+            first = int(first)
+            last = min(int(last), len(data) - 1) if last else len(data) - 1
+            self.set_status(206)
+            self.set_header('Content-Range', 'bytes {0}-{1}/{2}'.format(
+                first, last, len(data)))
+            data = data[first:last + 1]
+        self.finish(data)
+
+    def put(self, db_name, doc_id, name):
+        db = self.get_db(db_name)
+        doc = dict(db.docs.get(doc_id) or {'_id': doc_id})
+        rev = self.get_query_argument('rev', None)
+        if rev is not None or '_rev' in doc:
+            doc['_rev'] = rev
+        data = self.request.body
+        content_type = self.request.headers.get('Content-Type',
+                                                'application/octet-stream')
+        attachments = dict(doc.get('_attachments', {}))
+        attachments[name] = {
+            'content_type': content_type, 'length': len(data), 'stub': True,
+            'digest': 'md5-' + hashlib.md5(data).hexdigest()}
+        doc['_attachments'] = attachments
+        rev = db.save(doc)
+        db.attachments[(doc_id, name)] = (content_type, data)
+        self.send({'ok': True, 'id': doc_id, 'rev': rev}, 201)
+
+    def delete(self, db_name, doc_id, name):
+        db = self.get_db(db_name)
+        doc = dict(self.get_doc(db, doc_id))
+        if (doc_id, name) not in db.attachments:
+            raise _Error(404, 'not_found', 'Document is missing attachment')
+        doc['_rev'] = self.get_query_argument('rev', None)
+        doc['_attachments'] = dict(doc['_attachments'])
+        del doc['_attachments'][name]
+        rev = db.save(doc)
+        if not doc['_attachments']:
+            # as CouchDB, a doc without attachments has no _attachments
+            del db.docs[doc_id]['_attachments']
+        del db.attachments[(doc_id, name)]
+        self.send({'ok': True, 'id': doc_id, 'rev': rev})
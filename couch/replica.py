@@ -0,0 +1,358 @@
+"""Local read replica of a CouchDB database in SQLite, kept in sync by
+following the changes feed.
+
+This module is not imported by the `couch` package, import it explicitly::
+
+    from couch.replica import Replica
+"""
+
+import json
+import sqlite3
+import time
+
+try:
+    from urllib.parse import urlsplit, urlunsplit
+except ImportError:
+    # Python 2
+    from urlparse import urlsplit, urlunsplit
+
+from tornado import gen, httpclient
+from tornado.escape import utf8
+
+from .couch import NotFound, _query_string
+
+
+__all__ = ["Replica"]
+
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS docs (
+    id TEXT PRIMARY KEY,
+    rev TEXT NOT NULL,
+    gen INTEGER NOT NULL,
+    body BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+'''
+
+# newer revisions replace the stored doc, older revisions are ignored, as
+# the changes feed may be behind the docs saved through the replica
+_UPSERT = '''
+INSERT INTO docs (id, rev, gen, body) VALUES (?, ?, ?, ?)
+ON CONFLICT (id) DO UPDATE SET rev = excluded.rev, gen = excluded.gen,
+    body = excluded.body
+WHERE excluded.gen >= docs.gen
+'''
+
+_DELETE = 'DELETE FROM docs WHERE id = ? AND gen <= ?'
+
+# query parameters of the _all_docs view, that are served locally
+_local_params = frozenset(['startkey', 'start_key', 'endkey', 'end_key',
+                           'inclusive_end', 'descending', 'limit', 'skip',
+                           'include_docs', 'keys'])
+
+
+def _without_userinfo(url):
+    # the url without any credentials, for storing it
+    parts = urlsplit(url)
+    return urlunsplit(parts._replace(netloc=parts.netloc.rpartition('@')[2]))
+
+
+def _generation(rev):
+    # the generation number of a revision, e.g. 3 of '3-917fa23...'
+    return int(rev.split('-', 1)[0])
+
+
+class Replica(object):
+    """Read replica of the database of an `AsyncCouch` client, in a local
+    SQLite database.
+
+    Example usage::
+
+        db = couch.AsyncCouch('mydb')
+        replica = Replica(db, 'mydb.sqlite')
+        yield replica.sync()
+        replica.start()
+        doc = yield replica.get_doc('mydoc', max_lag=5.0)
+
+    The replica is stored in the SQLite database file at `path`, or in
+    memory. It follows the changes feed of the database, from the last
+    sequence stored with the docs, applying up to `batch_size` changes in a
+    transaction. `sync()` catches up with the database once, and `start()`
+    keeps following the changes, using long polling, until `close()`.
+    Failed polls are retried after `retry_delay` seconds.
+
+    `get_doc()`, `get_docs()` and `view_all_docs()` are served from the
+    replica, unless its `lag` exceeds the `max_lag` given to the call, in
+    seconds, then they are passed on to the client. Writes using the
+    document methods of the replica are made by the client, and the saved
+    docs are stored in the replica. Other methods are those of the client.
+
+    Deleted docs are not stored in the replica, and are missing, as are
+    docs not yet replicated. Attachments are not stored, only their stubs.
+    """
+
+    def __init__(self, client, path=':memory:', batch_size=1000,
+                 poll_timeout=60.0, retry_delay=1.0):
+        self.client = client
+        self.path = path
+        self.batch_size = batch_size
+        self.poll_timeout = poll_timeout
+        self.retry_delay = retry_delay
+        self.pending = None
+        self.synced_at = None
+        self.error = None
+        self._following = False
+        self._waiting = False
+        self._in_sync = False
+        self._conn = sqlite3.connect(path)
+        self._conn.executescript(_SCHEMA)
+        source = _without_userinfo('{0}{1}'.format(client.couch_url,
+                                                   client.db_name))
+        row = self._conn.execute(
+            "SELECT value FROM meta WHERE key = 'source'").fetchone()
+        if row is not None and _without_userinfo(row[0]) != source:
+            raise ValueError('Replica of another database: {0}'.format(
+                _without_userinfo(row[0])))
+        if row is None or row[0] != source:
+            # also removes credentials stored by earlier versions
+            with self._conn:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO meta (key, value) "
+                    "VALUES ('source', ?)", (source,))
+        row = self._conn.execute(
+            "SELECT value FROM meta WHERE key = 'last_seq'").fetchone()
+        self.last_seq = json.loads(row[0]) if row else 0
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    @property
+    def lag(self):
+        """Seconds the replica may be behind the database. It is 0 while
+        the replica is in sync, waiting for changes, and infinite before
+        the first sync."""
+        if self._waiting:
+            return 0.0
+        if self.synced_at is None:
+            return float('inf')
+        return time.time() - self.synced_at
+
+    @gen.coroutine
+    def sync(self):
+        """Catch up with the changes of the database, once."""
+        yield self._poll('normal')
+        while not self._in_sync:
+            yield self._poll('normal')
+
+    def start(self):
+        """Keep following the changes of the database, until closed."""
+        if not self._following:
+            self._following = True
+            self._follow()
+
+    def close(self):
+        """Stop following the changes, and close the SQLite database. The
+        client is not closed."""
+        self._following = False
+        self._conn.close()
+
+    #
+    # Document operations
+    #
+
+    @gen.coroutine
+    def get_doc(self, doc_id, max_lag=None):
+        """Get document with the given `doc_id`, see `AsyncCouch.get_doc()`.
+        """
+        if self._stale(max_lag):
+            r = yield self.client.get_doc(doc_id)
+            raise gen.Return(r)
+        row = self._conn.execute('SELECT body FROM docs WHERE id = ?',
+                                 (doc_id,)).fetchone()
+        if row is None:
+            raise NotFound(httpclient.HTTPError(404, 'missing'))
+        raise gen.Return(self.client._decode(row[0]))
+
+    @gen.coroutine
+    def get_docs(self, doc_ids, missing='raise', max_lag=None):
+        """Get multiple documents with the given list of `doc_ids`, see
+        `AsyncCouch.get_docs()`."""
+        if self._stale(max_lag):
+            r = yield self.client.get_docs(doc_ids, missing)
+            raise gen.Return(r)
+        found = {}
+        # stay below the limit of host parameters of SQLite
+        for i in range(0, len(doc_ids), 500):
+            chunk = doc_ids[i:i + 500]
+            found.update(self._conn.execute(
+                'SELECT id, body FROM docs WHERE id IN ({0})'.format(
+                    ','.join('?' * len(chunk))), chunk))
+        if missing == 'raise' and len(found) < len(set(doc_ids)):
+            raise NotFound(httpclient.HTTPError(404, 'missing'))
+        raise gen.Return([self.client._decode(found[doc_id])
+                          if doc_id in found else missing
+                          for doc_id in doc_ids])
+
+    @gen.coroutine
+    def save_doc(self, doc):
+        """Save a document using the client, and store it in the replica."""
+        r = yield self.client.save_doc(doc)
+        self._store([dict(doc, _id=r['id'], _rev=r['rev'])])
+        raise gen.Return(r)
+
+    @gen.coroutine
+    def save_docs(self, docs, all_or_nothing=False):
+        """Save documents using the client, and store them in the replica.
+        """
+        r = yield self.client.save_docs(docs, all_or_nothing)
+        self._store([dict(doc, _id=item['id'], _rev=item['rev'])
+                     for doc, item in zip(docs, r) if 'rev' in item])
+        raise gen.Return(r)
+
+    @gen.coroutine
+    def delete_doc(self, doc):
+        """Delete a document using the client, and from the replica."""
+        r = yield self.client.delete_doc(doc)
+        self._store([{'_id': r['id'], '_rev': r['rev'], '_deleted': True}])
+        raise gen.Return(r)
+
+    @gen.coroutine
+    def delete_docs(self, docs, all_or_nothing=False):
+        """Delete documents using the client, and from the replica."""
+        r = yield self.client.delete_docs(docs, all_or_nothing)
+        self._store([{'_id': item['id'], '_rev': item['rev'],
+                      '_deleted': True} for item in r if 'rev' in item])
+        raise gen.Return(r)
+
+    #
+    # View operations
+    #
+
+    @gen.coroutine
+    def view_all_docs(self, max_lag=None, **kwargs):
+        """Query the _all_docs view, see `AsyncCouch.view_all_docs()`.
+
+        The parameters `startkey`, `endkey`, `inclusive_end`, `descending`,
+        `limit`, `skip`, `include_docs` and `keys` are served locally. Deleted
+        docs are missing from the rows of `keys`. Queries with other
+        parameters are passed on to the client.
+        """
+        if self._stale(max_lag) or not _local_params.issuperset(kwargs):
+            r = yield self.client.view_all_docs(**kwargs)
+            raise gen.Return(r)
+        include_docs = kwargs.get('include_docs', False)
+        columns = 'id, rev, body' if include_docs else 'id, rev'
+        if 'keys' in kwargs:
+            keys = kwargs['keys']
+            found = {}
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                found.update((row[0], row) for row in self._conn.execute(
+                    'SELECT {0} FROM docs WHERE id IN ({1})'.format(
+                        columns, ','.join('?' * len(chunk))), chunk))
+            rows = [self._row(found[key], include_docs) if key in found
+                    else {'key': key, 'error': 'not_found'} for key in keys]
+        else:
+            descending = kwargs.get('descending', False)
+            startkey = kwargs.get('startkey', kwargs.get('start_key'))
+            endkey = kwargs.get('endkey', kwargs.get('end_key'))
+            where, params = [], []
+            if startkey is not None:
+                where.append('id <= ?' if descending else 'id >= ?')
+                params.append(startkey)
+            if endkey is not None:
+                if kwargs.get('inclusive_end', True):
+                    where.append('id >= ?' if descending else 'id <= ?')
+                else:
+                    where.append('id > ?' if descending else 'id < ?')
+                params.append(endkey)
+            sql = 'SELECT {0} FROM docs{1} ORDER BY id {2} LIMIT ? OFFSET ?'
+            sql = sql.format(columns,
+                             ' WHERE ' + ' AND '.join(where) if where else '',
+                             'DESC' if descending else 'ASC')
+            limit = kwargs.get('limit')
+            params.extend([-1 if limit is None else limit,
+                           kwargs.get('skip', 0)])
+            rows = [self._row(row, include_docs)
+                    for row in self._conn.execute(sql, params)]
+        total = self._conn.execute('SELECT COUNT(*) FROM docs').fetchone()[0]
+        raise gen.Return({'total_rows': total, 'rows': rows})
+
+    def _row(self, row, include_docs):
+        result = {'id': row[0], 'key': row[0], 'value': {'rev': row[1]}}
+        if include_docs:
+            result['doc'] = self.client._decode(row[2])
+        return result
+
+    #
+    # Following the changes feed
+    #
+
+    def _stale(self, max_lag):
+        # whether the replica is too far behind for a read
+        return max_lag is not None and self.lag > max_lag
+
+    @gen.coroutine
+    def _follow(self):
+        while self._following:
+            try:
+                yield self._poll('longpoll')
+                self.error = None
+            except Exception as e:
+                if not self._following:
+                    break
+                self.error = e
+                self._in_sync = False
+                yield gen.sleep(self.retry_delay)
+
+    @gen.coroutine
+    def _poll(self, feed):
+        # get a batch of changes since the last sequence, and apply them
+        query = {'feed': feed, 'since': self.last_seq, 'include_docs': True,
+                 'limit': self.batch_size}
+        kwargs = {}
+        if feed == 'longpoll':
+            query['timeout'] = int(self.poll_timeout * 1000)
+            kwargs['request_timeout'] = self.poll_timeout + 30.0
+        url = '{0}/_changes?{1}'.format(self.client.db_name,
+                                        _query_string(query))
+        # waiting for changes, the replica stays in sync
+        self._waiting = self._in_sync and feed == 'longpoll'
+        try:
+            resp = yield self.client._fetch('GET', url, decode=True, **kwargs)
+            r = self.client._parse_response(resp)
+        finally:
+            self._waiting = False
+        if not self._following and feed == 'longpoll':
+            # closed while polling
+            return
+        results = r['results']
+        self._store([row['doc'] for row in results if 'doc' in row],
+                    r['last_seq'])
+        self.last_seq = r['last_seq']
+        self.pending = r.get('pending')
+        self._in_sync = (self.pending == 0 if self.pending is not None
+                         else len(results) < self.batch_size)
+        if self._in_sync:
+            self.synced_at = time.time()
+
+    def _store(self, docs, last_seq=None):
+        # store or delete the docs, and the last sequence, in a transaction
+        encode = self.client._encode
+        with self._conn:
+            for doc in docs:
+                gen_ = _generation(doc['_rev'])
+                if doc.get('_deleted'):
+                    self._conn.execute(_DELETE, (doc['_id'], gen_))
+                else:
+                    self._conn.execute(_UPSERT, (
+                        doc['_id'], doc['_rev'], gen_,
+                        sqlite3.Binary(utf8(encode(doc)))))
+            if last_seq is not None:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO meta (key, value) "
+                    "VALUES ('last_seq', ?)", (json.dumps(last_seq),))